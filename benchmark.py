@@ -0,0 +1,152 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import corpus
+import exporter
+import loaders
+import matching
+import merge
+import metrics
+
+# Benchmark of the whole merge (see script.py) on synthetic databases (see corpus.py)
+#
+# For every size, a corpus is generated and the merge is run in a fresh process, timing each
+#   stage separately: load HH, load LWS, load SI, match, export (with a 'metrics.Metrics', the
+#   same as script.py).  The three loaders run at the same time (see 'loaders.read_all'), so
+#   the time loading took as a whole is recorded as 'load', and counts towards the total.
+#   Matching and exporting are interleaved in 'merge.merge_songs', so the time spent inside
+#   'export' (plus waiting for the files to be written at the end) counts as 'export', and the
+#   rest of the merge as 'match'.
+#   The number of song pairs looked at and fuzzy-scored, and the peak memory use of the
+#   process (and of its worker processes) are recorded as well.
+#
+# The results are written as JSON, so runs of different versions can be compared:
+#   python benchmark.py --sizes 1000 10000 --output results.json
+
+
+def run(directory, workers, use_index, memory=None, archive=None):
+    """Run the merge on the databases in 'directory' and return the measurements.
+    If 'memory' is given, the merge runs out of core with that memory cap (see 'store.py').
+    If 'archive' is 'zip' or 'tar', the songs are written into an archive of that kind
+    (see 'exporter.ArchiveExporter') instead of into a directory.
+    """
+    run_metrics = metrics.Metrics()
+    if memory is not None:
+        matching.token_cache.max_bytes = memory     # as script.py does
+    start = time.perf_counter()
+    HH_songs, LWS_songs, SI_songs, SI_errors = loaders.read_all(directory, workers, run_metrics)
+    load = time.perf_counter() - start
+
+    output = os.path.join(directory, 'SongDatabase')
+    shutil.rmtree(output, ignore_errors=True)
+    if archive is None:
+        os.mkdir(output)
+        song_database = exporter.Exporter(output)
+    else:
+        output = output + '.' + archive
+        if os.path.exists(output):
+            os.remove(output)
+        song_database = exporter.ArchiveExporter(output)
+    export = run_metrics.timed('export', song_database.export)
+    store_directory = None if memory is None else os.path.join(directory, 'store')
+    merge.merge_songs([SI_songs, HH_songs, LWS_songs], export, workers, use_index,
+                      metrics=run_metrics, store_directory=store_directory, memory=memory)
+    with run_metrics.stage('export'):
+        song_database.close()
+
+    result = dict(run_metrics.seconds)
+    result['load'] = load
+    result['total'] = sum(result[stage] for stage in ('load', 'match', 'export'))
+    result['songs'] = {'HH': len(HH_songs), 'LWS': len(LWS_songs), 'SI': len(SI_songs),
+                       'SI_errors': len(SI_errors), 'exported': run_metrics.songs['export']}
+    result['metrics'] = run_metrics.summary()
+    result['pairs'] = matching.counts['pairs']
+    result['comparisons'] = matching.counts['compared']
+    # peak resident memory, in kB on Linux
+    result['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_worker_memory_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return result
+
+
+def version():
+    """The git commit of this checkout, if there is one."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the stages of the song merge on synthetic databases.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='songs per database (default: 1000 10000)')
+    parser.add_argument('--exact', type=float, default=0.2, help='fraction of exact duplicates')
+    parser.add_argument('--near', type=float, default=0.2, help='fraction of near duplicates')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--no-index', action='store_true', help='score every pair of songs')
+    parser.add_argument('--memory', type=int, metavar='BYTES',
+                        help='match out of core, holding about this many bytes of lyrics at once')
+    parser.add_argument('--archive', choices=['zip', 'tar'],
+                        help='export into one archive of this kind instead of a directory')
+    parser.add_argument('--output', default='benchmark.json', help='file to write the results to')
+    parser.add_argument('--keep', metavar='DIRECTORY',
+                        help='generate the databases here and keep them (default: a temporary directory)')
+    parser.add_argument('--run', metavar='DIRECTORY', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:    # one measurement, in a process of its own
+        with contextlib.redirect_stdout(sys.stderr):
+            result = run(args.run, args.workers, not args.no_index, args.memory, args.archive)
+        json.dump(result, sys.stdout)
+        return
+
+    results = {'version': version(), 'python': platform.python_version(),
+               'machine': platform.machine(), 'cpus': os.cpu_count(), 'date': time.time(),
+               'workers': args.workers, 'index': not args.no_index, 'memory': args.memory,
+               'archive': args.archive,
+               'exact': args.exact, 'near': args.near, 'seed': args.seed, 'runs': []}
+    for size in args.sizes:
+        directory = os.path.join(args.keep, str(size)) if args.keep else tempfile.mkdtemp()
+        try:
+            if not os.path.exists(os.path.join(directory, 'HH_songs.txt')):
+                start = time.perf_counter()
+                corpus.generate(directory, size, args.exact, args.near, args.seed)
+                print('{} songs: generated in {:.1f} s'.format(size, time.perf_counter() - start))
+            command = [sys.executable, os.path.abspath(__file__), '--run', directory,
+                       '--workers', str(args.workers)]
+            if args.no_index:
+                command.append('--no-index')
+            if args.memory:
+                command.extend(['--memory', str(args.memory)])
+            if args.archive:
+                command.extend(['--archive', args.archive])
+            output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        finally:
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+        result = json.loads(output)
+        result['size'] = size
+        results['runs'].append(result)
+        print('{} songs: '.format(size) + ', '.join('{} {:.2f} s'.format(stage, result[stage])
+              for stage in ('load_hh', 'load_lws', 'load_si', 'load', 'match', 'export', 'total'))
+              + ', {} comparisons, peak {:.0f} MB'.format(result['comparisons'],
+                                                           result['peak_memory_kb'] / 1024))
+
+    with open(args.output, 'w') as F:
+        json.dump(results, F, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import hashlib
+import os
+import pickle
+from collections import OrderedDict
+from fuzzywuzzy import fuzz
+
+# On-disk cache for re-runs of script.py
+#
+# Most songs don't change between runs, so there is no need to fuzzy-match them against each
+#   other again.  Every song is identified by a hash of its lyrics (so a changed song simply
+#   gets a new hash), and the cache remembers the ratio of every pair that was ever scored,
+#   by (query hash, target hash).  Only pairs where at least one of the songs is new or
+#   changed have to be scored again.  (The token-sorted lyrics are not kept here: they are
+#   worked out while the songs are loaded, see 'matching.token_cache'.)
+#
+# The cache holds at most 'max_entries' pairs, on disk and in memory while the script runs;
+#   when it is full, the entries that haven't been used for the longest time are thrown out
+#   first.
+
+MAX_ENTRIES = 2000000
+
+# Ratios depend on which SequenceMatcher fuzzywuzzy uses (python-Levenshtein if installed,
+#   otherwise difflib), so a cache written with the other one is not reused.
+MATCHER = fuzz.SequenceMatcher.__module__
+
+
+def lyrics_hash(lyrics):
+    """Return a short hash (bytes) identifying the lyrics string 'lyrics'."""
+    return hashlib.blake2b(lyrics.encode('utf-8'), digest_size=16).digest()
+
+
+class ScoreCache:
+    """Cache of pair scores, stored in the file 'path'.
+    Nothing is written to disk until 'save' is called.
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.scores = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as F:
+                    saved = pickle.load(F)
+                if saved['matcher'] == MATCHER:
+                    self.scores = saved['scores']
+                    self._trim()
+            except (OSError, EOFError, KeyError, pickle.UnpicklingError) as error:
+                print('Warning: ignoring unreadable cache file {}: {}'.format(path, error))
+
+    def key(self, lyrics):
+        return lyrics_hash(lyrics)
+
+    def get(self, query, target):
+        """Return the cached ratio for the pair of hashes (query, target), or None."""
+        try:
+            ratio = self.scores[query, target]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.scores.move_to_end((query, target))
+        self.hits += 1
+        return ratio
+
+    def put(self, query, target, ratio):
+        self.scores[query, target] = ratio
+        self._trim()
+
+    def _trim(self):
+        """Throw out the least recently used entries above 'max_entries'."""
+        while len(self.scores) > self.max_entries:
+            self.scores.popitem(last=False)
+
+    def save(self):
+        """Write the cache to disk (to a temporary file first, so an interrupted run can't
+        corrupt it).
+        """
+        temp = self.path + '.tmp'
+        with open(temp, 'wb') as F:
+            pickle.dump({'matcher': MATCHER, 'scores': self.scores}, F, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.path)
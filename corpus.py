@@ -0,0 +1,192 @@
+import json
+import os
+import random
+import sys
+
+# Synthetic song databases, for trying out and benchmarking script.py
+#
+# 'generate' writes an HH text file, an LWS JSON songbook and a directory of SI OpenLyrics
+#   files, in the same formats as the real databases (see script.py), with the same number
+#   of songs in each.  A fraction of the songs show up in more than one database:
+#   * exact duplicates - the same lyrics (ratio 100 after loading)
+#   * near duplicates  - a few words or lines changed, verses swapped (usually ratio >= 70)
+#   The rest of the songs are only found in one database.
+#
+# Run 'python corpus.py <directory> <songs> [exact fraction] [near fraction] [seed]'.
+
+# Common words of hymns and worship songs, roughly from most to least common;
+#   lyrics are made of these and of made-up words, so that rare words are really rare
+COMMON_WORDS = '''the and of to i you my in a is your lord we will me be for all his he our
+    god is love with jesus on who king heart name us are praise come so holy grace give
+    oh this that glory soul life free us forever let sing is christ there spirit now cross
+    way see lift father sin up from light know song peace hope can never high worthy over
+    lamb mercy blood power great faith shall down hallelujah earth every one day heaven
+    hands savior word strong rise stand night sweet joy good alone near still before
+    saved world above eyes voice fear eternal grave breath amazing fire rock friend'''.split()
+
+AUTHORS = ['John Newton', 'Isaac Watts', 'Charles Wesley', 'Fanny Crosby', 'Chris Tomlin',
+           'Matt Redman', 'Stuart Townend', 'Keith Getty', 'Horatio Spafford', 'Reginald Heber',
+           'Edward Mote', 'Robert Robinson', 'Lucy Johnson', 'Tim Hughes', 'Graham Kendrick']
+CHORDS = ['G', 'C', 'D', 'Em', 'Am', 'F', 'D/F#', 'Bm7', 'Cadd9', 'Dsus4']
+
+
+class _Words:
+    """Picks words: mostly common ones, sometimes made-up ones from a large vocabulary."""
+
+    def __init__(self, rng, vocabulary):
+        self.rng = rng
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        self.rare = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+                     for _ in range(vocabulary)]
+        self.weights = [1 / (rank + 1) for rank in range(len(COMMON_WORDS))]
+
+    def line(self):
+        words = []
+        for _ in range(self.rng.randint(4, 9)):
+            if self.rng.random() < 0.3:
+                words.append(self.rng.choice(self.rare))
+            else:
+                words.append(self.rng.choices(COMMON_WORDS, self.weights)[0])
+        words[0] = words[0].capitalize()
+        return ' '.join(words)
+
+    def song(self):
+        """A song is a list of verses; a verse is a list of lines."""
+        return [[self.line() for _ in range(self.rng.randint(2, 6))]
+                for _ in range(self.rng.randint(1, 6))]
+
+
+def _near_duplicate(rng, words, song):
+    """Return a slightly different version of 'song'."""
+    song = [list(verse) for verse in song]
+    for _ in range(rng.randint(1, 3)):
+        verse = rng.choice(song)
+        n = rng.randrange(len(verse))
+        line = verse[n].split()
+        line[rng.randrange(len(line))] = words.line().split()[0].lower()
+        verse[n] = ' '.join(line)
+    if rng.random() < 0.3:
+        rng.choice(song).append(words.line())
+    if len(song) > 1 and rng.random() < 0.3:
+        song[0], song[1] = song[1], song[0]
+    return song
+
+
+def _hh_text(rng, song, author):
+    """One song in HH text format, ending with its author & copyright line."""
+    spacing = rng.choice([0, 0, 1, 2])     # blank lines between lyric lines
+    lines = ['\n']
+    for v in range(len(song)):
+        if v > 0:
+            lines.append('\n')              # verses are separated by 1 blank line
+        for n in range(len(song[v])):
+            if n > 0:
+                lines.extend(['\n'] * spacing)
+            lines.append(song[v][n] + '\n')
+    lines.append('\n')
+    lines.append('<{}, (c) {} Public Domain\n'.format(author, rng.randint(1700, 2020)))
+    return ''.join(lines)
+
+
+def _lws_song(rng, words, song, number, title, chords):
+    def text(song):
+        verses = []
+        for verse in song:
+            lines = []
+            for line in verse:
+                if chords and rng.random() < 0.5:
+                    cut = rng.randrange(len(line))
+                    line = '{}[{}]{}'.format(line[:cut], rng.choice(CHORDS), line[cut:])
+                lines.append(line)
+            verses.append('| '.join(lines))
+        return '| | '.join(verses) + '| '
+
+    spanish = ''
+    if rng.random() < 0.3:
+        spanish = text(words.song())
+    return {'songbookEntryNumber': number, 'englishTitle': title, 'spanishTitle': '',
+            'englishWords': text(song), 'spanishWords': spanish, 'tabsFlag': chords,
+            'englishTabsFlag': chords, 'spanishTabsFlag': False, 'englishSheetMusic': '',
+            'spanishSheetMusic': '', 'video': '', 'audio': '', 'keyableEnglishTitle': title,
+            'keyableSpanishTitle': '', 'searchableTitle': title.lower(), 'searchableText': '',
+            'englishSortOrder': number, 'spanishSortOrder': number}
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _si_xml(song, title, authors):
+    verses = []
+    for v in range(len(song)):
+        verses.append('    <verse name="v{}">\n      <lines>{}</lines>\n    </verse>\n'
+                      .format(v + 1, '<br/>'.join(_escape(line) for line in song[v])))
+    return ("<?xml version='1.0' encoding='UTF-8'?>\n"
+            '<song xmlns="http://openlyrics.info/namespace/2009/song" version="0.8" '
+            'createdIn="OpenLP 2.4.6" modifiedIn="OpenLP 2.4.6">\n'
+            '  <properties>\n    <titles>\n      <title>{}</title>\n    </titles>\n'
+            '    <authors>\n{}    </authors>\n  </properties>\n  <lyrics>\n{}  </lyrics>\n</song>\n'
+            .format(_escape(title),
+                    ''.join('      <author>{}</author>\n'.format(_escape(a)) for a in authors),
+                    ''.join(verses)))
+
+
+def generate(directory, songs, exact=0.2, near=0.2, seed=0):
+    """Write HH_songs.txt, LWS_songs.json and SI_songs/*.xml with 'songs' songs each into
+    'directory'.  Args 'exact' and 'near' are the fractions of each database's songs that
+    are exact and near duplicates of songs in the other databases.
+    """
+    rng = random.Random(seed)
+    words = _Words(rng, max(2000, songs * 4))
+    shared_count = max(1, int(songs * (exact + near)))
+    shared = [words.song() for _ in range(shared_count)]
+    titles = [' '.join(words.line().split()[:3]) for _ in range(shared_count)]
+
+    def pick():
+        """Lyrics and the number of the shared song they came from (None for a new song)."""
+        r = rng.random()
+        if r < exact:
+            k = rng.randrange(shared_count)
+            return shared[k], k
+        if r < exact + near:
+            k = rng.randrange(shared_count)
+            return _near_duplicate(rng, words, shared[k]), k
+        return words.song(), None
+
+    os.makedirs(os.path.join(directory, 'SI_songs'), exist_ok=True)
+
+    with open(os.path.join(directory, 'HH_songs.txt'), 'w') as F:
+        for n in range(songs):
+            song, k = pick()
+            author = rng.choice(AUTHORS + ['Unknown'] * 5)
+            F.write(_hh_text(rng, song, author))
+
+    with open(os.path.join(directory, 'LWS_songs.json'), 'w') as F:
+        F.write('[')
+        for n in range(songs):
+            song, k = pick()
+            title = titles[k] if k is not None else 'Song {}'.format(n)
+            if n > 0:
+                F.write(',')
+            json.dump(_lws_song(rng, words, song, n + 1, title, rng.random() < 0.3), F)
+        F.write(']')
+
+    for n in range(songs):
+        song, k = pick()
+        title = titles[k] if k is not None else 'SI Song {}'.format(n)
+        authors = rng.sample(AUTHORS, rng.randint(0, 2))
+        if authors and rng.random() < 0.2:      # author in the title, as in some SI files
+            title = '{} ({})'.format(title, authors.pop())
+        with open(os.path.join(directory, 'SI_songs', 'song{:06d}.xml'.format(n)), 'w') as F:
+            F.write(_si_xml(song, title, authors or ['Author Unknown']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('usage: python corpus.py <directory> <songs> [exact fraction] [near fraction] [seed]')
+        sys.exit(1)
+    args = sys.argv[1:]
+    generate(args[0], int(args[1]),
+             float(args[2]) if len(args) > 2 else 0.2,
+             float(args[3]) if len(args) > 3 else 0.2,
+             int(args[4]) if len(args) > 4 else 0)
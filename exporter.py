@@ -0,0 +1,202 @@
+import io
+import os
+import queue
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+# Writing songs to the new database (see the export logic in script.py)
+#
+# Each song is converted to openlyrics XML format and written to its own file in the
+#   database directory, with the song title as the file name.  Separate versions of a song
+#   with the same title must not overwrite each other, so a digit is appended to the end of
+#   a file name if one of the same name exists already: 'title.xml', 'title_1.xml', ...
+#
+# Instead of asking the filesystem whether each of those names exists, the 'Exporter' lists
+#   the directory once and then keeps track of every name it hands out.  The files themselves
+#   are written by THREADS writer threads, each to a temporary file that is then renamed, so a
+#   half-written song file never shows up in the database.  The threads are started with the
+#   first song, so that worker processes started before that (like the scoring processes, see
+#   'matching.process_pool') are forked while there are no other threads.
+#
+# Songs waiting to be written are kept in a queue of at most QUEUE_SIZE songs: if the disk
+#   can't keep up, 'export' waits for room in the queue, rather than piling up the XML of
+#   every song in memory.
+#
+# On filesystems where every file costs a lot (network shares, overlay filesystems), the songs
+#   can go into one zip or tar archive instead ('ArchiveExporter'): the same file names are
+#   handed out the same way, and the files are written into the archive one after another by
+#   a single writer thread.  The archive unpacks to the same files, for importing into OpenLP.
+
+THREADS = 8
+QUEUE_SIZE = 256
+
+
+def openlyrics(song):
+    """Arg 'song' should be a 'songs.Song'.
+    Returns (title, XML): the title to use as the file name, and the song in openlyrics XML format.
+    """
+    lyrics = song.lyrics.replace('\n', '<br/>') # the OpenLyrics way of doing newlines
+    title = song.title
+    authors = song.authors
+
+    # forward slash in the title is problematic because linux interprets it as part of the filepath
+    title = title.replace('/', ';')
+    # '&' character is apparently not allowed in text stored in XML
+    title = title.replace('&', 'and')
+    lyrics = lyrics.replace('&', 'and')
+
+    # a blank line indicates the start of a new verse
+    verses = lyrics.split('<br/><br/>')
+
+    xml = ["<?xml version='1.0' encoding='UTF-8'?>\n",
+           """<song xmlns="http://openlyrics.info/namespace/2009/song" version="0.8">\n""",
+           "  <properties>\n    <titles>\n      <title>{}</title>\n    </titles>\n    <authors>\n"
+                .format(title)]
+    for author in authors:
+        xml.append("      <author>{}</author>\n".format(author))
+    xml.append("    </authors>\n  </properties>\n  <lyrics>\n")
+    for i in range(len(verses)):
+        xml.append("""    <verse name="v{}">\n      <lines>{}</lines>\n    </verse>\n"""
+                .format(i+1, verses[i]))
+    xml.append("  </lyrics>\n</song>")
+    return title, ''.join(xml)
+
+
+class Exporter:
+    """Writes songs as openlyrics XML files into 'directory'.
+    Call 'export' for each song, then 'close' to wait until every file is written.
+    """
+
+    def __init__(self, directory, threads=THREADS, queue_size=QUEUE_SIZE):
+        self.directory = directory
+        # temporary files are created private; give the song files the usual permissions
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self._start(set(os.listdir(directory)), threads, queue_size)
+
+    def _start(self, taken, threads, queue_size):
+        self.taken = taken      # file names that exist already
+        self.next_number = {}   # title -> the first number that might still be free
+        self.queue = queue.Queue(queue_size)    # (file path, XML) of each song to write
+        self.errors = []
+        self.writers = [threading.Thread(target=self._writer, daemon=True) for i in range(threads)]
+        self.started = False
+
+    def filename(self, title):
+        """Return a file name for 'title' that hasn't been used yet, and mark it as used."""
+        name = '{}.xml'.format(title)
+        i = self.next_number.get(title, 1)
+        while name in self.taken:
+            name = '{}_{}.xml'.format(title, i)
+            i += 1
+        self.next_number[title] = i
+        self.taken.add(name)
+        return name
+
+    def export(self, song, name=None):
+        """Arg 'song' should be a 'songs.Song'.
+        The song is converted right away (so changing it afterwards makes no difference),
+        and written to the database in the background.  Returns the path of the new file.
+        If a file 'name' is given, the song is written to that file (replacing it, or in an
+        archive, added again under the same name) instead of one named after its title.
+        """
+        if not self.started:
+            for writer in self.writers:
+                writer.start()
+            self.started = True
+        title, xml = openlyrics(song)
+        if name is None:
+            name = self.filename(title)
+        filepath = os.path.join(self.directory, name)
+        self.queue.put((filepath, xml))
+        return filepath
+
+    def _writer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as error:  # keep going, so that 'export' never waits forever
+                self.errors.append(error)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, filepath, xml):
+        # write to a temporary file next to the song file, then rename it
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'w') as F:
+                F.write(xml)
+            os.chmod(temp, 0o666 & ~self.umask)
+            os.replace(temp, filepath)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def flush(self):
+        """Wait until every song exported so far is written; raises the first error that
+        happened, if any.
+        """
+        self.queue.join()
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def close(self):
+        """Wait for all files to be written; raises the first error that happened, if any."""
+        if self.started:
+            for writer in self.writers:
+                self.queue.put(None)
+            for writer in self.writers:
+                writer.join()
+        self.writers = []
+        if self.errors:
+            raise self.errors[0]
+
+
+class ArchiveExporter(Exporter):
+    """Writes songs as openlyrics XML files into the zip or tar archive 'path' (a zip file if
+    the name ends in '.zip', otherwise an uncompressed tar file); if the archive exists
+    already, the songs are added to it.
+    Call 'export' for each song, then 'close' to wait until every file is written and close
+    the archive.  The paths 'export' returns are 'path' joined with the name in the archive.
+    """
+
+    def __init__(self, path, queue_size=QUEUE_SIZE):
+        self.directory = path
+        if path.endswith('.zip'):
+            self.archive = zipfile.ZipFile(path, 'a', zipfile.ZIP_DEFLATED)
+            taken = set(self.archive.namelist())
+        else:
+            self.archive = tarfile.open(path, 'a')
+            taken = set(self.archive.getnames())
+        self._start(taken, 1, queue_size)
+
+    def _write(self, filepath, xml):
+        name = os.path.basename(filepath)
+        data = xml.encode('utf-8')
+        if isinstance(self.archive, zipfile.ZipFile):
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self.archive.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        """Wait for all files to be written and close the archive; raises the first error
+        that happened, if any.
+        """
+        try:
+            Exporter.close(self)
+        finally:
+            self.archive.close()
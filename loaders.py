@@ -0,0 +1,419 @@
+import contextlib
+import glob
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+import matching
+from songs import Song, UNKNOWN_AUTHORS, UNKNOWN_TITLE
+
+# Loaders for the song databases used by script.py
+#
+# Each loader gives 'songs.Song' records, numbered in the order they were read.
+#
+# The token-sorted lyrics and the signature of every song (which matching needs, see
+#   'matching.signature') are worked out as the songs are loaded - by the worker processes,
+#   if there are any - and kept in 'matching.token_cache'.
+
+
+# HH Songs:
+#   The songs in the text file are not separated consistently (see script.py), so the lines of
+#   each song are gathered until its author & copyright line (which starts with '<') shows up,
+#   and then the blank lines of the song are sorted out:
+#   * If lyric lines are separated by 2 or more blank lines, every run of 2 or more blank lines
+#       is deleted, while single blank lines (verse separators) are kept.
+#   * If every lyric line is 1 blank line apart, there is no telling lines from verses, so all
+#       blank lines are deleted.
+#   * Otherwise lyric lines are not separated by blank lines at all, and only a blank line at
+#       the beginning or end of the song is deleted.
+#
+#   Only the lines of one song are ever held in memory, and each song is processed in one pass.
+
+def read_hh_songs(path):
+    """Generator yielding the songs in the HH text file at 'path', one at a time."""
+    with open(path, 'r') as songfile:
+        lines = []
+        number = 0
+        for line in songfile:
+            if line[0] == '<':  # end of song
+                # title info is not available
+                yield Song(_hh_lyrics(lines), UNKNOWN_TITLE, _hh_authors(line), 'HH', number)
+                number += 1
+                lines = []
+            else:               # gather lines of song
+                lines.append(line)
+
+
+def _hh_lyrics(lines):
+    """Assemble the raw lines of one HH song into lyrics."""
+    # Split the song into 'runs': every run is a lyric line, or a number of blank lines in a row.
+    #   'runs' holds [first line number, number of lines, blank?] for each run.
+    runs = []
+    for n in range(len(lines)):
+        blank = lines[n] == '\n'
+        if blank and runs != [] and runs[-1][2]:
+            runs[-1][1] += 1
+        else:
+            runs.append([n, 1, blank])
+
+    # number of blank lines in front of each lyric line (0 for a line right after another one);
+    #   most and fewest blank lines separating lyric lines in the raw song
+    newlines = []
+    for k in range(len(runs)):
+        if not runs[k][2]:
+            if k > 0 and runs[k-1][2]:
+                newlines.append(runs[k-1][1])
+            else:
+                newlines.append(0)
+    most_newlines = max(newlines)
+    fewest_newlines = min(newlines)
+
+    if most_newlines >= 2:   # lyric lines are separated by >= 2 blank lines
+        keep = []
+        for k in range(len(runs)):
+            first, count, blank = runs[k]
+            # A run of blank lines at the very beginning of a song is only deleted if the song
+            #   doesn't end with a blank line
+            if blank and count >= 2 and (first > 0 or lines[-1] != '\n'):
+                continue
+            keep.extend(lines[first:first+count])
+        # delete first and last blank line
+        if keep[0] == '\n':
+            del keep[0]
+        if keep[-1] == '\n':
+            del keep[-1]
+
+    elif most_newlines == 1 and fewest_newlines == 1:   # all lines in song are 1 blank line apart
+        # remove all blank lines
+        keep = [line for line in lines if line != '\n']
+
+    else:   # lyric lines are separated by 0 blank lines
+        # remove first and last lines (if blank)
+        start = 1 if lines[0] == '\n' else 0
+        end = len(lines) - 1 if lines[-1] == '\n' and len(lines) > start else len(lines)
+        keep = lines[start:end]
+
+    return ''.join(keep)
+
+
+def _hh_authors(line):
+    """Find the author in the author & copyright line of an HH song, i.e. '<Author, ...'."""
+    author = line[1:line.index(',', 1)]
+    if 'nknown' not in author:  # avoid 'Unknown' (this is trying to be case insensitive)
+        return (author,)
+    return UNKNOWN_AUTHORS
+
+
+# LWS Songs:
+#   The songbook is one big JSON array of song objects (see script.py for their keys).
+#   Instead of reading and decoding the whole array at once, the file is read in blocks of
+#   LWS_BLOCK characters and one song object is decoded at a time.
+
+LWS_BLOCK = 65536
+
+# In the lyrics, tablatures are anything in brackets, and newlines are pipes:
+#   '| ' and '|\t' are newlines ('\n' and '\n\t'), and any other pipe is thrown away.
+#   A pipe, any tablatures or other pipes right after it, and the space or tab after those
+#   are all replaced at once, so the lyrics only have to be gone through once.
+_LWS_MARKUP = re.compile(r'\[[^\]]*\]|\|(?:\||\[[^\]]*\])*([ \t])?')
+_LWS_NEWLINES = {' ': '\n', '\t': '\n\t', None: ''}
+# a '[' that is followed by another '[' (or by nothing) before its ']'
+_LWS_UNCLOSED = re.compile(r'\[[^\]]*(?:\[|\Z)')
+
+
+def read_lws_songs(path):
+    """Generator yielding the songs in the LWS JSON file at 'path', one at a time."""
+    number = 0
+    for song in _json_array(path):
+        # get english and spanish lyrics together
+        lyrics = song['englishWords']
+        lyrics = lyrics.lstrip()    # remove any whitespace from the beginning
+        espanol = song['spanishWords'].lstrip()
+        if espanol != "":
+            if lyrics[len(lyrics)-2:] == '| ':
+                lyrics = lyrics + "\n" + espanol
+            else:
+                lyrics = lyrics + "\n\n" + espanol
+
+        # remove tablatures and turn pipes into newlines
+        if _LWS_UNCLOSED.search(lyrics):
+            lyrics = _lws_lyrics_unclosed(lyrics)
+        else:
+            lyrics = _LWS_MARKUP.sub(lambda match: _LWS_NEWLINES[match.group(1)], lyrics)
+
+        # author info is not available
+        yield Song(lyrics, song['englishTitle'], UNKNOWN_AUTHORS, 'LWS', number)
+        number += 1
+
+
+def _lws_lyrics_unclosed(lyrics):
+    """Remove tablatures and pipes from 'lyrics' when its brackets don't pair up, the same
+    (character by character) way it has always been done, so the result doesn't change.
+    """
+    # remove tablatures (anything in brackets) from lyrics
+    delete_lines = []
+    for i in range(len(lyrics)-1):
+        if lyrics[i] == '[':
+            delete_lines.append(i)
+            n = 0
+            while lyrics[i+n] != ']':
+                delete_lines.append(i+(n+1))
+                n += 1
+    for index in delete_lines:
+        lyrics = lyrics[:index] + lyrics[index+1:]
+        for i in range(len(delete_lines)):
+            delete_lines[i] = delete_lines[i] - 1
+
+    # newlines: replace '| ' with '\n'
+    lyrics = lyrics.replace('| ', '\n')
+    lyrics = lyrics.replace('|\t', '\n\t')  # sometimes that happens too
+    return lyrics.replace('|', '')          # get rid of any remaining pipes !!
+
+
+def _json_array(path):
+    """Generator yielding the items of the JSON array in the file at 'path', one at a time,
+    without reading the whole file into memory.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[\s,]*')     # between items
+    with open(path) as J:
+        buffer = J.read(LWS_BLOCK).lstrip()
+        if buffer[:1] != '[':
+            raise ValueError('{} does not contain a JSON array'.format(path))
+        buffer = buffer[1:]
+        end_of_file = False
+        while True:
+            buffer = buffer[whitespace.match(buffer).end():]
+            if buffer[:1] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                # probably the item doesn't fit in the buffer yet; read some more
+                if end_of_file:
+                    raise
+                block = J.read(LWS_BLOCK)
+                end_of_file = block == ''
+                buffer = buffer + block
+                continue
+            yield item
+            buffer = buffer[end:]
+
+
+# SI songs:
+#   Every song is a separate OpenLyrics XML file.  Only the first title, the authors, and the
+#   verses (with '<br/>' as newlines) are needed, so each file is parsed as a stream of elements
+#   ('iterparse'), and every verse is thrown away as soon as its lyrics have been read.
+#   The files can be split up between several processes.
+
+SI_CHUNK_SIZE = 16     # files handed to a worker process at a time
+
+
+def read_si_songs(directory, workers=1, pool=None):
+    """Read every OpenLyrics XML file in 'directory'.
+    Arg 'workers' is the number of processes to split the files between; if a 'pool' of them
+    is given (see 'matching.process_pool'), that one is used.
+    Returns (songs, errors): the list of songs that could be read, in the order of the files,
+    and a list of (file name, error message) for each file that couldn't.
+    """
+    files = glob.glob(os.path.join(directory, '*.xml'))
+    if workers <= 1 or len(files) <= SI_CHUNK_SIZE:
+        results = [_read_si_file(path) for path in files]
+    elif pool is not None:
+        results = list(pool.map(_read_si_file, files, chunksize=SI_CHUNK_SIZE))
+    else:
+        with matching.process_pool(workers) as pool:
+            results = list(pool.map(_read_si_file, files, chunksize=SI_CHUNK_SIZE))
+
+    songs = []
+    errors = []
+    for n in range(len(files)):
+        song, error = results[n]
+        if error is None:
+            lyrics, title, authors, text, signature = song
+            matching.token_cache.add(lyrics, text, signature)
+            songs.append(Song(lyrics, title, authors, 'SI', len(songs)))
+        else:
+            errors.append((os.path.basename(files[n]), error))
+    return songs, errors
+
+
+def read_si_song(path, number=0):
+    """Read the one OpenLyrics file 'path' (like 'read_si_songs', numbering the song 'number').
+    Returns (song, None), or (None, error message) if the file couldn't be read.
+    """
+    song, error = _read_si_file(path)
+    if error is not None:
+        return None, error
+    lyrics, title, authors, text, signature = song
+    matching.token_cache.add(lyrics, text, signature)
+    return Song(lyrics, title, authors, 'SI', number), None
+
+
+def _read_si_file(path):
+    """Read one OpenLyrics file; returns ([lyrics, title, authors, token-sorted lyrics,
+    signature], None), or (None, error message).
+    """
+    try:
+        title, authors, verses = _parse_openlyrics(path)
+    except (OSError, ET.ParseError, ValueError) as error:
+        return None, str(error)
+    if title is None:
+        return None, 'no title found'
+
+    # look for authors in the title
+    authors_in_title = []
+    if '(' in title or '-' in title:
+        charbuff = []
+        active = False
+        for char in title:
+            if char == '(' or char == '-':
+                active = True
+            else:
+                if active == True:
+                    if char == ')':
+                        author = ''.join(charbuff)
+                        if 'Spanish' not in author:     # happened a few times
+                            authors_in_title.append(author)
+                        charbuff = []
+                        active = False
+                    else:
+                        charbuff.append(char)
+        if charbuff != []:
+            authors_in_title.append(''.join(charbuff[1:]))
+        # delete parentheses and their contents from title
+        try:
+            title = title[0:title.index('(')]
+        except ValueError:
+            pass
+
+    # then the authors where they actually should be
+    authors = authors_in_title + [author for author in authors if author != 'Author Unknown']
+    if authors == []:    # still empty
+        authors.append('Author Unknown')
+
+    lyrics = '\n\n'.join(verses)
+    text = matching.sort_tokens(lyrics)
+    return [lyrics, title, authors, text, matching.signature(lyrics, text)], None
+
+
+def _parse_openlyrics(path):
+    """Return the first title, the list of authors, and the list of verses (lyrics
+    with newlines) found in the OpenLyrics file at 'path'.
+    """
+    title = None
+    authors = []
+    verses = []
+    parents = []    # names of the elements we are inside of
+    for event, element in ET.iterparse(path, events=('start', 'end')):
+        name = _local_name(element.tag)
+        if event == 'start':
+            parents.append(name)
+            continue
+        parents.pop()
+        if name == 'title' and parents[-2:] == ['properties', 'titles']:
+            if title is None:
+                title = element.text or ''
+        elif name == 'author' and parents[-2:] == ['properties', 'authors']:
+            authors.append(element.text)
+        elif parents[-2:] == ['song', 'lyrics']:    # lyrics are separated into verses -- so nice!
+            verses.append(_verse_lyrics(element, title))
+            element.clear()
+    return title, authors, verses
+
+
+def _verse_lyrics(verse, title):
+    """Return the lyrics of the first '<lines>' in 'verse', treating '<br/>' as a newline."""
+    for lines in verse.iter():
+        if _local_name(lines.tag) == 'lines':
+            break
+    else:
+        raise ValueError('no lines found in a verse of song: {}'.format(title))
+    text = [lines.text or '']
+    for line in lines:
+        if _local_name(line.tag) != 'br':
+            raise ValueError('unknown tag <{}> found in lyrics of song: {}'
+                    .format(_local_name(line.tag), title))
+        text.append('\n')
+        text.append(line.tail or '')
+    return ''.join(text)
+
+
+def _local_name(tag):
+    """Tag name without its namespace, i.e. 'song' for '{http://openlyrics.info/...}song'."""
+    return tag[tag.rfind('}')+1:]
+
+
+# All three databases:
+#   The loaders don't depend on each other, so they are run at the same time, each in a
+#   thread of its own.  Only one thread runs Python code at a time, though, so that only
+#   saves time while a loader waits - for the disk, or for the worker processes (which are
+#   started before the threads, see 'matching.process_pool').  With worker processes, the
+#   HH and LWS songs are normalized by them as well, NORMALIZE_CHUNK_SIZE songs at a time,
+#   while the loader threads go on reading.
+
+NORMALIZE_CHUNK_SIZE = 256
+
+
+def _normalize(lyrics):
+    """Return (token-sorted lyrics, signature) for each lyrics string in the list 'lyrics'."""
+    normalized = []
+    for song_lyrics in lyrics:
+        text = matching.sort_tokens(song_lyrics)
+        normalized.append((text, matching.signature(song_lyrics, text)))
+    return normalized
+
+
+def read_all(directory, workers=1, metrics=None):
+    """Read 'HH_songs.txt', 'LWS_songs.json' and the 'SI_songs' directory in 'directory',
+    all at the same time, and cache the token-sorted lyrics and signature of every song (see
+    the top of this file).  Arg 'workers' is passed on to 'read_si_songs'.
+    The time each loader takes is counted as the stage 'load_hh', 'load_lws' or 'load_si' of
+    'metrics' (a 'metrics.Metrics'), if given.
+    Returns (HH_songs, LWS_songs, SI_songs, SI_errors).
+    """
+    def load(stage, read, *args):
+        with contextlib.nullcontext() if metrics is None else metrics.stage(stage):
+            return read(*args)
+
+    def read_normalized(read, path):
+        songs = []
+        if processes is None:
+            for song in read(path):
+                matching.token_cache.sort_tokens(song.lyrics)
+                songs.append(song)
+            return songs
+        chunks = []     # (songs, future of their normalized lyrics)
+        chunk = []
+        for song in read(path):
+            songs.append(song)
+            chunk.append(song)
+            if len(chunk) == NORMALIZE_CHUNK_SIZE:
+                chunks.append((chunk, processes.submit(_normalize, [song.lyrics for song in chunk])))
+                chunk = []
+        if chunk:
+            chunks.append((chunk, processes.submit(_normalize, [song.lyrics for song in chunk])))
+        for chunk, normalized in chunks:
+            for song, (text, signature) in zip(chunk, normalized.result()):
+                matching.token_cache.add(song.lyrics, text, signature)
+        return songs
+
+    processes = matching.process_pool(workers) if workers > 1 else None
+    try:
+        with ThreadPoolExecutor(3) as pool:
+            HH = pool.submit(load, 'load_hh', read_normalized, read_hh_songs,
+                             os.path.join(directory, 'HH_songs.txt'))
+            LWS = pool.submit(load, 'load_lws', read_normalized, read_lws_songs,
+                              os.path.join(directory, 'LWS_songs.json'))
+            SI = pool.submit(load, 'load_si', read_si_songs, os.path.join(directory, 'SI_songs'),
+                             workers, processes)
+            HH_songs, LWS_songs, (SI_songs, SI_errors) = HH.result(), LWS.result(), SI.result()
+    finally:
+        if processes is not None:
+            processes.shutdown()
+    if metrics is not None:
+        metrics.processed('load_hh', len(HH_songs))
+        metrics.processed('load_lws', len(LWS_songs))
+        metrics.processed('load_si', len(SI_songs))
+    return HH_songs, LWS_songs, SI_songs, SI_errors
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import cache
+import matching
+from songs import Song, UNKNOWN_TITLE
+
+# Record of what has been exported to the new database, for adding to it later (see script.py)
+#
+# The manifest is an SQLite file with two tables:
+#   * 'files' - every song file written to the database: its file name, title, authors, the
+#       source the song came from, a fingerprint of its lyrics (see 'cache.lyrics_hash'), its
+#       token signature (the token-sorted lyrics, see 'matching.sort_tokens'), its sketches
+#       (see 'matching.signature') and which song of the source it was (see 'identity')
+#   * 'seen'  - the fingerprint of every source song that has been dealt with, whether it was
+#       written to a file or not (e.g. because it was identical to another version)
+#
+# In append mode, only the source songs that haven't been seen yet (new songs, and songs whose
+#   lyrics changed) are merged, with the songs already in the database as the first source:
+#   their token signatures and sketches are all that is needed to match against them, so none
+#   of the song files has to be read back.  A new song that matches one of them is exported
+#   under the same title as a separate version (or not at all, if it is identical).
+#
+# A song whose lyrics were edited in its source is new as well, but its old version is still
+#   in the database.  The source song a file was written for is recorded by its identity:
+#   its title in the source (which merging may change), or its number if the source has no
+#   titles.  If the source no longer has a song with the lyrics of a file, but has exactly one
+#   song of the same identity, that song has changed: it is written over the file, instead of
+#   next to it (see 'outdated').  Every other file already in the database is never touched.
+
+SOURCE = 'SongDatabase'     # the 'source' of the songs read back from the manifest
+
+
+def identity(song):
+    """Return what identifies 'song' in its source, even once its lyrics change (see above)."""
+    if song.title == UNKNOWN_TITLE:
+        return '#{}'.format(song.number)
+    return song.title
+
+
+class Manifest:
+    """The manifest stored in the SQLite file 'path' (created if it doesn't exist)."""
+
+    def __init__(self, path):
+        self.path = path
+        self.identities = {}    # song -> its identity, see 'track'
+        self.replacing = {}     # song -> the file it is written over, see 'outdated'
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS files (
+            name TEXT PRIMARY KEY, title TEXT, authors TEXT, source TEXT,
+            fingerprint BLOB, signature TEXT, sketches BLOB, identity TEXT)''')
+        # manifests from before these were kept: their songs are sketched from their token
+        #   signatures, and their files are never taken for the old version of a song
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(files)')]
+        for column, kind in (('sketches', 'BLOB'), ('identity', 'TEXT')):
+            if column not in columns:
+                self.connection.execute('ALTER TABLE files ADD COLUMN {} {}'.format(column, kind))
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS seen (
+            source TEXT, fingerprint BLOB, PRIMARY KEY (source, fingerprint))''')
+
+    def clear(self):
+        """Forget everything (for a database that is being written from scratch)."""
+        self.connection.execute('DELETE FROM files')
+        self.connection.execute('DELETE FROM seen')
+
+    def songs(self, start=0, leave_out=()):
+        """Return the songs already in the database as a list of 'songs.Song', with their
+        token signatures as lyrics (which is all matching needs, with the sketches, which are
+        put in 'matching.token_cache'); only the songs from number 'start' on, if given, and
+        not those of the files named in 'leave_out'.
+        """
+        rows = self.connection.execute('SELECT name, title, authors, signature, sketches FROM files '
+                                       'ORDER BY rowid LIMIT -1 OFFSET ?', (start,))
+        songs = []
+        for n, (name, title, authors, signature, sketches) in enumerate(rows, start):
+            if name in leave_out:
+                continue
+            if sketches is not None:
+                matching.token_cache.add(signature, signature, matching.from_signature_bytes(sketches))
+            songs.append(Song(signature, title, json.loads(authors), SOURCE, n))
+        return songs
+
+    def files(self, start=0):
+        """Return (file name, fingerprint) of the songs already in the database, in the order
+        of 'songs'.
+        """
+        rows = self.connection.execute('SELECT name, fingerprint FROM files ORDER BY rowid LIMIT -1 OFFSET ?',
+                                       (start,))
+        return [(name, fingerprint) for name, fingerprint in rows]
+
+    def is_new(self, song):
+        """Return whether 'song' hasn't been seen yet (see 'new_songs')."""
+        row = self.connection.execute('SELECT 1 FROM seen WHERE source = ? AND fingerprint = ?',
+                                      (song.source, cache.lyrics_hash(song.lyrics))).fetchone()
+        return row is None
+
+    def new_songs(self, songs):
+        """Return the songs in the list 'songs' that haven't been seen yet."""
+        seen = set(self.connection.execute('SELECT source, fingerprint FROM seen'))
+        return [song for song in songs if (song.source, cache.lyrics_hash(song.lyrics)) not in seen]
+
+    def track(self, songs):
+        """Remember the identity of every song in the list 'songs' (see 'identity') while its
+        title is still the one from its source, for recording it with its file.
+        """
+        for song in songs:
+            self.identities[song] = identity(song)
+
+    def outdated(self, songs):
+        """Find the files written for songs that have changed since (see the top of this file),
+        given the list 'songs' of all the source songs ('track'ed).  A changed song that hasn't
+        been seen yet will be written over its file; other old versions are only reported
+        (e.g. when the new version was written next to the old one in watch mode).
+        Returns the names of the files that will be replaced.
+        """
+        current = {}        # (source, identity) -> the songs with it
+        fingerprints = set()
+        for song in songs:
+            current.setdefault((song.source, self.identities[song]), []).append(song)
+            fingerprints.add((song.source, cache.lyrics_hash(song.lyrics)))
+        files = {}          # (source, identity) -> (file name, fingerprint) of the files with it
+        for name, source, song_identity, fingerprint in self.connection.execute(
+                'SELECT name, source, identity, fingerprint FROM files WHERE identity IS NOT NULL'):
+            files.setdefault((source, song_identity), []).append((name, fingerprint))
+        seen = set(self.connection.execute('SELECT source, fingerprint FROM seen'))
+        replaced = []
+        for key in files:
+            if len(current.get(key, [])) != 1:
+                continue
+            song = current[key][0]
+            # the files whose song isn't in the source any more
+            stale = [name for name, fingerprint in files[key] if (key[0], fingerprint) not in fingerprints]
+            if len(stale) == 1 and (song.source, cache.lyrics_hash(song.lyrics)) not in seen:
+                print('{}: {} song {!r} has changed, replacing it'.format(stale[0], song.source, key[1]))
+                self.replacing[song] = stale[0]
+                replaced.append(stale[0])
+                continue
+            for name in stale:
+                print('Warning: {} has an old version of {} song {!r}, whose new version was '
+                      'dealt with before'.format(name, song.source, key[1]))
+        return replaced
+
+    def not_replaced(self):
+        """Return the names of the files from 'outdated' that weren't written over (the new
+        version of their song was identical to another song, so it wasn't written at all).
+        """
+        return sorted(self.replacing.values())
+
+    def add_seen(self, songs):
+        """Mark every song in the list 'songs' as dealt with."""
+        self.connection.executemany('INSERT OR IGNORE INTO seen VALUES (?, ?)',
+                                    [(song.source, cache.lyrics_hash(song.lyrics)) for song in songs])
+
+    def add_file(self, filepath, song):
+        """Record that 'song' was written to the file 'filepath' (replacing what was recorded
+        for that file, if anything).
+        """
+        self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                (os.path.basename(filepath), song.title, json.dumps(song.authors),
+                                 song.source, cache.lyrics_hash(song.lyrics),
+                                 matching.token_cache.sort_tokens(song.lyrics),
+                                 matching.signature_bytes(matching.token_cache.signature(song.lyrics)),
+                                 self.identities.get(song)))
+
+    def exporter(self, export):
+        """Return an 'export' function that calls 'export' (e.g. 'exporter.Exporter.export',
+        which returns the path of the new file) and records the file; songs that came from
+        the manifest are already in the database, and are skipped.  A changed song (see
+        'outdated') is written over the file of its old version.
+        """
+        def export_and_record(song):
+            if song.source == SOURCE:
+                return
+            name = self.replacing.pop(song, None)
+            self.add_file(export(song, name), song)
+        return export_and_record
+
+    def save(self):
+        """Save all changes so far."""
+        self.connection.commit()
+
+    def close(self):
+        """Save all changes and close the file."""
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,968 @@
+import array
+import bisect
+import collections
+import multiprocessing
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils
+from songs import Song, UNKNOWN_AUTHORS, UNKNOWN_TITLE
+try:
+    import numpy    # needed for 'score_matrix'; makes 'SortedLyrics.screen' worth doing
+except ImportError:
+    numpy = None
+
+# Fuzzy matching helpers used by script.py
+#
+# Two songs are counted as a match when 'fuzz.token_sort_ratio' of their lyrics is 70 or
+#   greater, and as identical when it is 100 (see README).  Scoring every song of one list
+#   against every song of another is slow once the lists hold thousands of songs, so this
+#   module builds a 'candidate index' over a list of songs:
+#   * The lyrics of each song are normalized the same way 'token_sort_ratio' does it
+#       (lower case, letters and numbers only) and split into words ('tokens').
+#   * An inverted index maps every token to the songs that contain it.
+#   * A query song is only scored against songs that share enough of its *rare* tokens;
+#       two versions of the same song share most of their words, so they always share rare
+#       ones too, while unrelated songs usually only share words like 'the' and 'lord'.
+#
+# 'token_sort_ratio(a, b)' is really 'ratio(sort_tokens(a), sort_tokens(b))', so instead of
+#   calling it once per pair (which normalizes and sorts both songs every time), each song is
+#   token-sorted once per batch and the batch is scored with 'score_row'/'score_pairs', which
+#   also skip pairs that can't reach the cutoff because their lengths are too different.
+#   The songs being searched are kept sorted by length as well ('SortedLyrics'), so a song
+#   that is scored against all of them only looks at the ones of a length that could match.
+#
+# Identical songs (ratio 100) are very common between the databases, so 'match_all' first looks
+#   each song up by its token-sorted lyrics in a hash map of the songs being searched (the
+#   'exact fast path').  A song with an identical version there is only scored against the
+#   few songs that could also reach 100 and come before it in the list - which is all that
+#   'claim' needs to pick the same song as it would from the full list of matches.  Only if
+#   all of those have been used by the time the song is claimed are its matches worked out
+#   in full (see 'ExactMatches').
+#
+# Scoring is a cascade: before a pair is fuzzy-scored, the cheap *signatures* of the two songs
+#   are compared.  A song's signature is two sketches: small bit sets with one bit for each
+#   word (hashed into SKETCH_BITS bits) of all its lyrics, and of its first OPENING_LINES
+#   lines.  Two sketches give a quick estimate of how many words the songs have in common out
+#   of all the words in both (their Jaccard similarity).  Songs that share less than
+#   SKETCH_THRESHOLD of their words, and less than OPENING_THRESHOLD of the words of their
+#   first lines, are hardly ever a match, and are not fuzzy-scored; the first lines keep
+#   versions with extra verses (like the Spanish verses of LWS songs) in.  Unlike the length
+#   and character bounds this can lose a match now and then; 'check_cascade' measures how
+#   many (SKETCH_THRESHOLD = 0 turns the cascade off).  The line layout is only there in the
+#   raw lyrics, so signatures are worked out while the songs are loaded, and cached with the
+#   token-sorted lyrics (see 'token_cache').
+
+THRESHOLD = 70      # a ratio of at least this much is 'probably a match'
+
+# Recall knobs for 'TokenIndex':
+#   PROBE_TOKENS - how many of the query's rarest tokens are looked up in the index (rarest
+#       among the songs searched, leaving out tokens none of them has)
+#   MIN_SHARED   - how many of those a song must share with the query to be scored at all
+# Raising PROBE_TOKENS or lowering MIN_SHARED finds more candidates (better recall, slower);
+#   MIN_SHARED = 1 and PROBE_TOKENS = 0 (no limit) scores every song sharing any word.
+PROBE_TOKENS = 24
+MIN_SHARED = 2
+
+# Work done by 'score_row' so far (in this process, and in worker processes started by 'match_all'):
+#   'pairs'    - pairs of songs looked at
+#   'compared' - pairs that actually had to be fuzzy-scored (the rest were equal, or pruned)
+#   'sketched' - pairs that were left out by comparing sketches (see above)
+# and by 'match_all':
+#   'exact'    - songs (or songs x ranges, see 'match_all') that took the exact fast path
+#   'fallback' - of those, the ones whose matches had to be worked out in full after all
+counts = {'pairs': 0, 'compared': 0, 'sketched': 0, 'exact': 0, 'fallback': 0}
+
+# The characters left in lyrics after normalizing; 'SortedLyrics.screen' counts these
+ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789_ '
+# 'SortedLyrics.screen' is only worth calling on at least this many pairs at once
+MIN_BOUND = 16
+
+# The cascade (see above): the size of a sketch, the estimated share of words two songs must
+#   have in common to be fuzzy-scored, and the same for their first OPENING_LINES lines (above
+#   1, only whole lyrics are compared)
+SKETCH_BITS = 512
+SKETCH_THRESHOLD = 0.2
+OPENING_LINES = 4
+OPENING_THRESHOLD = 0.5
+if numpy is not None:
+    _POPCOUNT = numpy.array([bin(byte).count('1') for byte in range(256)], dtype=numpy.int64)
+
+# Out-of-core matching ('match_store'): the songs being searched are put back together from
+#   a 'store.TokenStore' a block at a time, each block taking up about MEMORY bytes;
+#   SONG_OVERHEAD is a rough guess of what a song takes besides the characters of its lyrics
+#   (the string object itself, its histogram, its place in the 'SortedLyrics' lists).  The
+#   postings of the candidate index for the block ('StoreIndex') take about half as much again.
+#   The songs of the block to score each query against are held as lists of song numbers,
+#   about NUMBER_SIZE bytes each, MEMORY bytes of them at a time.
+MEMORY = 256 * 1024 * 1024
+SONG_OVERHEAD = 300
+NUMBER_SIZE = 40
+
+# Token-sorted lyrics (see 'sort_tokens') are needed over and over - for the candidate index,
+#   for scoring, for the manifest - so each song's are worked out once, while the songs are
+#   loaded, and kept in 'token_cache' for everything after that, with the song's signature
+#   (see 'signature'); it holds about TOKEN_CACHE_BYTES of them at most ('max_bytes', which
+#   script.py sets to its memory cap for out-of-core matching).
+TOKEN_CACHE_BYTES = 256 * 1024 * 1024
+
+# Scoring a list of songs against another list can be split up between several processes
+#   ('match_all'); each worker gets a chunk of CHUNK_SIZE query songs at a time.
+#   Worker processes are forked (see 'process_pool'): script.py runs everything at the top
+#   level, so a process that was spawned instead would run all of it again.
+CHUNK_SIZE = 32
+
+
+# the bit of every word sketched so far (most words turn up in many songs)
+_word_bits = {}
+
+
+def sketch(string):
+    """Return the sketch of a normalized string: an int with the bit of each of its words set."""
+    bits = 0
+    for word in set(string.split()):
+        bit = _word_bits.get(word)
+        if bit is None:
+            bit = _word_bits[word] = 1 << (zlib.crc32(word.encode()) % SKETCH_BITS)
+        bits |= bit
+    return bits
+
+
+def signature(lyrics, text=None):
+    """Return the signature of a song for the cascade (see the top of this file): the sketch
+    of its token-sorted lyrics 'text' (worked out if not given), and the sketch of the first
+    OPENING_LINES lines of its 'lyrics'.  (Lyrics that are token-sorted already have just
+    the one line, so both sketches are the same.)
+    """
+    if text is None:
+        text = sort_tokens(lyrics)
+    opening = [line for line in lyrics.split('\n') if line.strip()][:OPENING_LINES]
+    return sketch(text), sketch(utils.full_process(' '.join(opening), force_ascii=True))
+
+
+def _sketch_bytes(bits):
+    return bits.to_bytes(SKETCH_BITS // 8, 'little')
+
+
+def signature_bytes(signature):
+    """Return a signature as 2 * SKETCH_BITS / 8 bytes (e.g. for keeping it in a file)."""
+    return b''.join([_sketch_bytes(bits) for bits in signature])
+
+
+def from_signature_bytes(data):
+    """The opposite of 'signature_bytes'."""
+    size = SKETCH_BITS // 8
+    return int.from_bytes(data[:size], 'little'), int.from_bytes(data[size:], 'little')
+
+
+def _bits(signature):
+    return bin(signature[0]).count('1'), bin(signature[1]).count('1')
+
+
+def sort_tokens(lyrics):
+    """Return 'lyrics' normalized and token-sorted, exactly as 'fuzz.token_sort_ratio' does it
+    before comparing two strings.
+    """
+    return ' '.join(sorted(utils.full_process(lyrics, force_ascii=True).split())).strip()
+
+
+class TokenCache:
+    """Token-sorted lyrics (see 'sort_tokens') and signatures (see 'signature') by lyrics,
+    about 'max_bytes' of them at most; when it is full, the ones used least recently are
+    dropped (and worked out again if they are needed after all).  It can be used by several
+    threads at once.
+    """
+
+    def __init__(self, max_bytes=TOKEN_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()    # lyrics -> (token-sorted lyrics, signature)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, lyrics):
+        with self.lock:
+            entry = self.entries.get(lyrics)
+            if entry is not None:
+                self.entries.move_to_end(lyrics)
+                self.hits += 1
+                return entry
+            self.misses += 1
+        text = sort_tokens(lyrics)
+        entry = (text, signature(lyrics, text))
+        self.add(lyrics, *entry)
+        return entry
+
+    def sort_tokens(self, lyrics):
+        """Return 'sort_tokens(lyrics)', working it out only if it isn't cached."""
+        return self._get(lyrics)[0]
+
+    def signature(self, lyrics):
+        """Return 'signature(lyrics)', working it out only if it isn't cached."""
+        return self._get(lyrics)[1]
+
+    def add(self, lyrics, text, signature):
+        """Cache 'text' as the token-sorted form of 'lyrics', and its 'signature' (e.g. worked
+        out in another process).
+        """
+        with self.lock:
+            if lyrics in self.entries:
+                return
+            self.entries[lyrics] = (text, signature)
+            self.size += len(text) + SONG_OVERHEAD
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                lyrics, (text, _) = self.entries.popitem(last=False)
+                self.size -= len(text) + SONG_OVERHEAD
+
+
+token_cache = TokenCache()
+
+
+class TokenIndex:
+    """Inverted index over the lyrics of a list of songs.
+    Arg 'lyrics' is a list of token-sorted lyrics (see 'sort_tokens'); song numbers in the
+    index are positions in that list.
+    """
+
+    def __init__(self, lyrics, probe_tokens=PROBE_TOKENS, min_shared=MIN_SHARED):
+        self.probe_tokens = probe_tokens
+        self.min_shared = min_shared
+        self.postings = {}      # token -> list of song numbers containing that token
+        self.size = len(lyrics)
+        for j in range(len(lyrics)):
+            for token in set(lyrics[j].split()):
+                self.postings.setdefault(token, []).append(j)
+
+    def add(self, lyrics):
+        """Add the token-sorted 'lyrics' to the index, as the next song number."""
+        for token in set(lyrics.split()):
+            self.postings.setdefault(token, []).append(self.size)
+        self.size += 1
+
+    def candidates(self, lyrics, first=0):
+        """Return a sorted list of the song numbers that should be scored against the
+        token-sorted 'lyrics' (leaving out the songs numbered below 'first').
+        """
+        query = set(lyrics.split())
+        if query == set():
+            # an empty song can only match other empty songs; let the caller score everything
+            return list(range(first, self.size))
+
+        # rarest tokens first, counting only the songs from 'first' on: tokens that no song
+        #   there has (e.g. words of the query's own) can't find anything, and mustn't use up
+        #   the probes
+        known = {}      # token -> where its postings from 'first' on start
+        for token in query:
+            postings = self.postings.get(token)
+            if postings is not None:
+                start = bisect.bisect_left(postings, first) if first else 0
+                if start < len(postings):
+                    known[token] = start
+        probes = sorted(known, key=lambda token: (len(self.postings[token]) - known[token], token))
+        if self.probe_tokens:
+            probes = probes[:self.probe_tokens]
+
+        # a song that shares fewer tokens than this can't be required to share more
+        needed = min(self.min_shared, len(probes))
+        if needed == 0:
+            return []
+        shared = collections.Counter()
+        for token in probes:
+            shared.update(self.postings[token][known[token]:])
+        return sorted(j for j in shared if shared[j] >= needed)
+
+
+class StoreIndex:
+    """Candidate index over the songs in a 'store.TokenStore', for 'match_store'.
+    It gives the same candidates as a 'TokenIndex' over all of their token-sorted lyrics, but
+    only holds the postings of one block of songs at a time (see 'load'); all it keeps for
+    the whole store is how many songs have each token, from each of the song numbers in
+    'firsts' on (the first songs that queries are matched against), to pick the rarest
+    tokens of a song by.  Tokens are token ids of the store, rather than words.
+    """
+
+    def __init__(self, store, firsts=(0,), probe_tokens=PROBE_TOKENS, min_shared=MIN_SHARED):
+        self.store = store
+        self.probe_tokens = probe_tokens
+        self.min_shared = min_shared
+        self.frequencies = {}   # first -> how many songs from 'first' on have each token
+        counts = array.array('I', bytes(4 * len(store.vocabulary)))
+        end = len(store)
+        for first in sorted(set(firsts), reverse=True):
+            for j in range(first, end):
+                for token in set(store.token_ids(j)):
+                    counts[token] += 1
+            self.frequencies[first] = array.array('I', counts)
+            end = first
+        self.postings = {}      # token -> array of the numbers of the loaded songs containing it
+        self.first = self.last = 0
+
+    def probes(self, n, first=0):
+        """Return the tokens of song 'n' that its candidates among the songs from 'first' on
+        (one of 'firsts') are looked up by, rarest first (see 'TokenIndex.candidates').
+        """
+        vocabulary = self.store.vocabulary
+        frequencies = self.frequencies[first]
+        known = sorted([token for token in set(self.store.token_ids(n)) if frequencies[token]],
+                       key=lambda token: (frequencies[token], vocabulary[token]))
+        return known[:self.probe_tokens] if self.probe_tokens else known
+
+    def load(self, first, last):
+        """Hold the postings of the songs numbered 'first' to 'last'-1 (and of no others)."""
+        self.postings = {}
+        for j in range(first, last):
+            for token in set(self.store.token_ids(j)):
+                postings = self.postings.get(token)
+                if postings is None:
+                    postings = self.postings[token] = array.array('I')
+                postings.append(j)
+        self.first, self.last = first, last
+
+    def candidates(self, n, probes, first=0):
+        """Return a sorted list of the loaded songs that should be scored against song 'n',
+        whose tokens to look up are 'probes' (see 'probes'), leaving out the songs numbered
+        below 'first'.
+        """
+        if self.store.lengths[n] == 0:
+            # an empty song can only match other empty songs; let the caller score everything
+            return list(range(max(first, self.first), self.last))
+        needed = min(self.min_shared, len(probes))
+        if needed == 0:
+            return []
+        first = max(first, self.first)
+        shared = collections.Counter()
+        for token in probes:
+            postings = self.postings.get(token)
+            if postings is not None:
+                shared.update(postings[bisect.bisect_left(postings, first):])
+        return sorted(j for j in shared if shared[j] >= needed)
+
+
+class SortedLyrics:
+    """A list of token-sorted lyrics (see 'sort_tokens'), as searched by 'score_row'.
+    It is indexed like the list; it also keeps the song numbers in order of length, the
+    signature of each song, and (with NumPy) how often each character of ALPHABET occurs in it.
+    Songs are only fuzzy-scored against a query if their sketches share at least
+    'sketch_threshold' of their bits, or those of their first lines OPENING_THRESHOLD
+    (see 'sift').  Arg 'signatures' is the list of the songs' signatures (see 'signature');
+    without it, the strings are taken to be the songs' lyrics.  Arg 'histograms' is the list of
+    the strings' histograms (see 'histogram'), if they were worked out before.
+    """
+
+    def __init__(self, strings, sketch_threshold=SKETCH_THRESHOLD, signatures=None, histograms=None):
+        self.strings = strings
+        self.sketch_threshold = sketch_threshold
+        self.opening_threshold = OPENING_THRESHOLD
+        self.signatures = None
+        if sketch_threshold > 0:
+            if signatures is None:
+                signatures = [signature(string, string) for string in strings]
+            self.signatures = list(signatures)
+            self.signature_bits = [_bits(pair) for pair in self.signatures]
+        self.by_length = sorted(range(len(strings)), key=lambda j: len(strings[j]))
+        self.lengths = [len(strings[j]) for j in self.by_length]
+        self.histograms = None
+        if numpy is not None and strings:
+            self.histograms, self.sizes, self.sketch_bytes, self.sketch_counts = self._arrays(0, histograms)
+
+    def _arrays(self, start, histograms=None):
+        """Return the NumPy arrays for the songs from number 'start' on: the character
+        histograms (worked out if not given), the lengths, and the signatures as rows of
+        2 sketches of bytes with the number of bits set in each sketch (None, None without
+        signatures).
+        """
+        strings = self.strings[start:]
+        if histograms is None:
+            histograms = [histogram(string) for string in strings]
+        histograms = numpy.array(histograms, dtype=numpy.int32)
+        sizes = numpy.array([len(string) for string in strings], dtype=numpy.int64)
+        if self.signatures is None:
+            return histograms, sizes, None, None
+        sketch_bytes = numpy.frombuffer(b''.join([signature_bytes(pair) for pair in self.signatures[start:]]),
+                                        dtype=numpy.uint8).reshape(len(strings), 2, -1)
+        return histograms, sizes, sketch_bytes, numpy.array(self.signature_bits[start:], dtype=numpy.int64)
+
+    def append(self, string, song_signature=None):
+        """Add the token-sorted 'string' to the end of the list (the list given to the
+        constructor, which grows with it), with its signature (see the constructor),
+        keeping everything else up to date.
+        """
+        j = len(self.strings)
+        self.strings.append(string)
+        if self.signatures is not None:
+            if song_signature is None:
+                song_signature = signature(string, string)
+            self.signatures.append(song_signature)
+            self.signature_bits.append(_bits(song_signature))
+        # after the songs of the same length, the same as sorting would put it
+        k = bisect.bisect_right(self.lengths, len(string))
+        self.lengths.insert(k, len(string))
+        self.by_length.insert(k, j)
+        if numpy is None:
+            return
+        if self.histograms is None:
+            self.histograms, self.sizes, self.sketch_bytes, self.sketch_counts = self._arrays(0)
+            return
+        arrays = self._arrays(j)
+        self.histograms = numpy.concatenate((self.histograms, arrays[0]))
+        self.sizes = numpy.concatenate((self.sizes, arrays[1]))
+        if self.signatures is not None:
+            self.sketch_bytes = numpy.concatenate((self.sketch_bytes, arrays[2]))
+            self.sketch_counts = numpy.concatenate((self.sketch_counts, arrays[3]))
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, j):
+        return self.strings[j]
+
+    def window(self, length, cutoff):
+        """Return the sorted numbers of the songs whose length doesn't rule out a ratio of
+        'cutoff' with a string of length 'length' (see 'score_row').
+        """
+        return window(self.by_length, self.lengths, length, cutoff)
+
+    def screen(self, query, numbers, cutoff, query_signature=None):
+        """Do what 'score_row' does before fuzzy-scoring, for all the songs of the list
+        'numbers' at once (NumPy only): return (the songs equal to 'query', the songs that
+        might still reach 'cutoff' against it).  On top of the length bound, this uses a
+        character bound: two strings can't have more characters in common than the smaller
+        count of each character, so the ratio can't be more than
+        200 * (characters in common) / (total length).  Then the signatures are compared
+        (see 'sift').
+        """
+        length = len(query)
+        rows = numpy.array(numbers, dtype=numpy.intp)
+        sizes = self.sizes[rows]
+        # 'equal' can't be pruned by any bound
+        equal = [j for j in rows[sizes == length].tolist() if self.strings[j] == query]
+        keep = 200 * numpy.minimum(sizes, length) >= (cutoff - 1) * (sizes + length)
+        if equal:
+            keep &= ~numpy.isin(rows, equal)
+        rows = rows[keep]
+        common = numpy.minimum(self.histograms[rows], histogram(query)).sum(axis=1)
+        rows = rows[200 * common >= (cutoff - 1) * (self.sizes[rows] + length)]
+        if self.signatures is not None and len(rows):
+            if query_signature is None:
+                query_signature = signature(query, query)
+            query_bytes = numpy.frombuffer(signature_bytes(query_signature), dtype=numpy.uint8).reshape(2, -1)
+            common = _POPCOUNT[self.sketch_bytes[rows] & query_bytes].sum(axis=2)
+            union = numpy.array(_bits(query_signature)) + self.sketch_counts[rows] - common
+            thresholds = numpy.array([self.sketch_threshold, self.opening_threshold])
+            kept = rows[(common >= thresholds * union).any(axis=1)]
+            counts['sketched'] += len(rows) - len(kept)
+            rows = kept
+        return equal, rows.tolist()
+
+    def sift(self, query, numbers, query_signature=None):
+        """Return the songs of the list 'numbers' whose signature is close enough to that of
+        'query' to be worth fuzzy-scoring (the first stage of the cascade): the bits set in
+        both sketches of the whole lyrics must be at least 'sketch_threshold' of the bits set
+        in either, or those of the first lines at least 'opening_threshold'.
+        Arg 'query_signature' is the signature of the query (see the constructor).
+        """
+        if self.signatures is None or not numbers:
+            return numbers
+        if query_signature is None:
+            query_signature = signature(query, query)
+        query_sketch, query_opening = query_signature
+        query_size, query_opening_size = _bits(query_signature)
+        threshold = self.sketch_threshold
+        opening_threshold = self.opening_threshold
+        signatures = self.signatures
+        sizes = self.signature_bits
+        kept = []
+        for j in numbers:
+            target_sketch, target_opening = signatures[j]
+            size, opening_size = sizes[j]
+            common = bin(query_sketch & target_sketch).count('1')
+            # common / (bits in either sketch) >= threshold
+            if common >= threshold * (query_size + size - common):
+                kept.append(j)
+                continue
+            common = bin(query_opening & target_opening).count('1')
+            if common >= opening_threshold * (query_opening_size + opening_size - common):
+                kept.append(j)
+        counts['sketched'] += len(numbers) - len(kept)
+        return kept
+
+
+def window(by_length, lengths, length, cutoff):
+    """Return the sorted song numbers out of 'by_length' (song numbers in order of length,
+    with 'lengths' their lengths) whose length doesn't rule out a ratio of 'cutoff' with a
+    string of length 'length'.
+    """
+    if cutoff <= 1:
+        return sorted(by_length)
+    # 200 * shorter >= (cutoff - 1) * (length + other length), solved for the other length
+    low = -(-(cutoff - 1) * length // (201 - cutoff))
+    high = (201 - cutoff) * length // (cutoff - 1)
+    start = bisect.bisect_left(lengths, low)
+    end = bisect.bisect_right(lengths, high)
+    return sorted(by_length[start:end])
+
+
+def histogram(string):
+    """Return how often each character of ALPHABET occurs in 'string', and then how many
+    other characters it has (those are all counted together, which can only raise the bound
+    in 'SortedLyrics.screen').
+    """
+    counted = [string.count(c) for c in ALPHABET]
+    counted.append(len(string) - sum(counted))
+    return counted
+
+
+def score_row(query, targets, numbers=None, cutoff=THRESHOLD, scored=None, query_signature=None):
+    """Score one token-sorted string 'query' against 'targets', a 'SortedLyrics';
+    arg 'numbers' limits the scoring to those positions in 'targets'.
+    Returns a list of (position, ratio) for every target with ratio >= 'cutoff', in list order.
+    The ratios are the same as 'fuzz.token_sort_ratio' would give for the original lyrics.
+    If a dict 'scored' is given, every ratio actually worked out (even below 'cutoff') is
+    stored in it by position.  Arg 'query_signature' is the signature of the query's song
+    (see 'signature'); without it, 'query' is taken to be the song's lyrics.
+    """
+    length = len(query)
+    if numbers is None:
+        counts['pairs'] += len(targets)
+        numbers = targets.window(length, cutoff)
+    else:
+        counts['pairs'] += len(numbers)
+    strings = targets.strings
+    if targets.histograms is not None and len(numbers) >= MIN_BOUND:
+        equal, left = targets.screen(query, numbers, cutoff, query_signature)
+    else:
+        equal = []
+        left = []
+        for j in numbers:
+            target = strings[j]
+            if target == query:
+                equal.append(j)
+                continue
+            # At most the whole of the shorter string can match, so the ratio can't be more than
+            #   200 * (shorter length) / (total length); don't bother scoring if that is too low.
+            #   (the bound is kept 1 point loose so rounding can never prune a real match)
+            shorter = min(length, len(target))
+            if 200 * shorter < (cutoff - 1) * (length + len(target)):
+                continue
+            left.append(j)
+        left = targets.sift(query, left, query_signature)
+    scores = [(j, 100) for j in equal]
+    if scored is not None:
+        for j in equal:
+            scored[j] = 100
+    for j in left:
+        ratio = fuzz.ratio(query, strings[j])
+        if scored is not None:
+            scored[j] = ratio
+        if ratio >= cutoff:
+            scores.append((j, ratio))
+    counts['compared'] += len(left)
+    scores.sort()
+    return scores
+
+
+def find_matches(lyrics, songs, index=None, sketch_threshold=0):
+    """Score 'lyrics' against the lyrics of each song in 'songs' (a list of 'songs.Song').
+    If a 'TokenIndex' built over 'songs' is given, only its candidates are scored.
+    Returns a list of (song number, ratio) for every song with ratio >= THRESHOLD, in list order.
+    By default every pair is scored; with a 'sketch_threshold' (say SKETCH_THRESHOLD) the
+    cascade is used as in 'match_all', which is faster but can leave out a match now and then.
+    """
+    return match_all([Song(lyrics, UNKNOWN_TITLE, UNKNOWN_AUTHORS, None, 0)], songs, index,
+                     exact=False, sketch_threshold=sketch_threshold)[0]
+
+
+def score_pairs(queries, targets, cutoff=THRESHOLD, index=None, sketch_threshold=0):
+    """Score every string in the list 'queries' against every string in the list 'targets'
+    (lyrics, not yet token-sorted).  If a 'TokenIndex' over 'targets' is given, only its
+    candidates are scored.
+    Returns a sparse list of (query position, target position, ratio) with ratio >= 'cutoff'.
+    As with 'find_matches', a 'sketch_threshold' above 0 can leave out some of those pairs.
+    """
+    targets = SortedLyrics([token_cache.sort_tokens(lyrics) for lyrics in targets], sketch_threshold,
+                           [token_cache.signature(lyrics) for lyrics in targets])
+    pairs = []
+    for i in range(len(queries)):
+        query = token_cache.sort_tokens(queries[i])
+        numbers = None if index is None else index.candidates(query)
+        for j, ratio in score_row(query, targets, numbers, cutoff, None, token_cache.signature(queries[i])):
+            pairs.append((i, j, ratio))
+    return pairs
+
+
+def score_matrix(queries, targets, cutoff=THRESHOLD, index=None, sketch_threshold=0):
+    """Like 'score_pairs', but returns a NumPy array of shape (len(queries), len(targets));
+    pairs that were pruned or scored below 'cutoff' are 0.
+    """
+    if numpy is None:
+        raise ImportError("'score_matrix' needs the python module 'numpy'")
+    matrix = numpy.zeros((len(queries), len(targets)), dtype=numpy.uint8)
+    for i, j, ratio in score_pairs(queries, targets, cutoff, index, sketch_threshold):
+        matrix[i, j] = ratio
+    return matrix
+
+
+# Every worker process keeps its own copy of the songs being searched,
+#   sent once when the process starts instead of once per chunk.
+_targets = None
+
+
+def _start_worker(targets):
+    global _targets
+    _targets = targets
+
+
+def _score_chunk(chunk):
+    before = dict(counts)
+    results = [_score_one(_targets, *job) for job in chunk]
+    return results, {key: counts[key] - before[key] for key in counts}
+
+
+def _score_one(targets, query, query_signature, numbers, keep_scores, cutoff):
+    scored = {} if keep_scores else None
+    return score_row(query, targets, numbers, cutoff, scored, query_signature), scored
+
+
+def _plan(numbers, same, start, end):
+    """Work out what to score a query against among the songs numbered 'start' to 'end'-1.
+    Arg 'numbers' is the sorted list of its candidates (None for all songs) and 'same' the
+    sorted numbers of the songs identical to it.
+    Returns (numbers, cutoff, whether the exact fast path is taken).
+    """
+    if numbers is not None:
+        numbers = numbers[bisect.bisect_left(numbers, start):bisect.bisect_left(numbers, end)]
+    same = same[bisect.bisect_left(same, start):bisect.bisect_left(same, end)]
+    if not same:
+        return numbers, THRESHOLD, False
+    # only songs up to the last identical one can be picked over it by 'claim'
+    return [j for j in (range(start, end) if numbers is None else numbers) if j <= same[-1]], 100, True
+
+
+def process_pool(workers, initializer=None, initargs=()):
+    """Return a 'ProcessPoolExecutor' with 'workers' forked processes, all started right away.
+    A process should only be forked while it has no threads besides the main one, so this
+    is called before any are started (see 'loaders.read_all' and 'exporter.Exporter').
+    """
+    pool = ProcessPoolExecutor(workers, multiprocessing.get_context('fork'), initializer, initargs)
+    # with 'fork', the pool starts all of its processes when it gets its first job
+    pool.submit(int).result()
+    return pool
+
+
+def _run(jobs, targets, workers):
+    """Generator scoring every job (see '_score_one') against 'targets', with 'workers'
+    processes, and yielding the results in the order of the jobs as soon as they are ready.
+    """
+    if workers <= 1 or len(jobs) <= CHUNK_SIZE:
+        for scoring in jobs:
+            yield _score_one(targets, *scoring)
+        return
+    chunks = [jobs[k:k+CHUNK_SIZE] for k in range(0, len(jobs), CHUNK_SIZE)]
+    with process_pool(workers, _start_worker, (targets,)) as pool:
+        # 'map' hands out all the chunks right away, and gives the results in order
+        for result, done in pool.map(_score_chunk, chunks):
+            for key in done:
+                counts[key] += done[key]
+            yield from result
+
+
+class ExactMatches(list):
+    """The matches 'match_all' found for a song through the exact fast path: every song with
+    ratio 100 up to the last song identical to it.  If 'claim' finds all of them used, it
+    calls 'fallback()' for the song's full list of matches.
+    """
+
+    def __init__(self, matches, fallback):
+        list.__init__(self, matches)
+        self.fallback = fallback
+
+
+def match_all(queries, songs, index=None, workers=1, cache=None, exact=True, ranges=None,
+              sketch_threshold=SKETCH_THRESHOLD):
+    """Call 'find_matches' for the lyrics of each song in 'queries' against 'songs'
+    (each song is only token-sorted once for the whole batch).
+    Returns a list with the matches of each query song (see 'iter_matches' for the args).
+    """
+    return list(iter_matches(queries, songs, index, workers, cache, exact, ranges, sketch_threshold))
+
+
+def iter_matches(queries, songs, index=None, workers=1, cache=None, exact=True, ranges=None,
+                 sketch_threshold=SKETCH_THRESHOLD):
+    """Generator yielding the matches of each song in 'queries' against 'songs', in order
+    (see 'match_all'); the matches of a song are yielded as soon as they are worked out,
+    while the worker processes go on with the songs after it.
+    Arg 'workers' is the number of processes to split the work between.
+    Arg 'cache' is an optional 'cache.ScoreCache'; pairs found in it are not scored again,
+    and newly scored pairs are added to it.
+    Arg 'exact' turns on the exact fast path (see the top of this file); the lists of matches
+    it gives are shorter, but 'claim' picks the same song from them.
+    Arg 'ranges' is an optional list with, for each query song, a list of (start, end) ranges
+    of song numbers in 'songs' (e.g. the songs of each of several databases); the query is
+    then only scored against those songs, and what is yielded for it is a list with the
+    matches in each range.
+    Arg 'sketch_threshold' is the first stage of the cascade (see 'SortedLyrics'); 0 scores
+    every pair that could reach the cutoff.
+
+    Nothing is claimed here: the matches of a song don't depend on which songs were already
+    used, so they can be worked out in any order, and 'claim' is then called on them one
+    song at a time in list order.  That way the result is the same for any number of workers.
+    """
+    sorted_queries = [token_cache.sort_tokens(song.lyrics) for song in queries]
+    targets = [token_cache.sort_tokens(song.lyrics) for song in songs]
+    if cache is not None:
+        query_keys = [cache.key(song.lyrics) for song in queries]
+        target_keys = [cache.key(song.lyrics) for song in songs]
+    query_signatures = [None] * len(queries)
+    target_signatures = None
+    if sketch_threshold > 0:
+        query_signatures = [token_cache.signature(song.lyrics) for song in queries]
+        target_signatures = [token_cache.signature(song.lyrics) for song in songs]
+
+    targets = SortedLyrics(targets, sketch_threshold, target_signatures)
+    identical = {}      # token-sorted lyrics -> numbers of the songs in 'songs' with those lyrics
+    if exact:
+        for j in range(len(targets)):
+            identical.setdefault(targets[j], []).append(j)
+
+    def job(n, numbers, cutoff):
+        """Look up the pairs of query 'n' in the cache; returns the job that scores the rest,
+        and the matches found in the cache.
+        """
+        if cache is None:
+            return (sorted_queries[n], query_signatures[n], numbers, False, cutoff), []
+        if numbers is None:
+            numbers = range(len(targets))
+        left = []
+        found = []
+        for j in numbers:
+            ratio = cache.get(query_keys[n], target_keys[j])
+            if ratio is None:
+                left.append(j)
+            elif ratio >= cutoff:
+                found.append((j, ratio))
+        return (sorted_queries[n], query_signatures[n], left, True, cutoff), found
+
+    def finish(n, result, found):
+        matches, scored = result
+        if cache is None:
+            return matches
+        for j in scored:
+            cache.put(query_keys[n], target_keys[j], scored[j])
+        return sorted(found + matches)
+
+    def fallback(n, numbers):
+        def full_matches():
+            counts['fallback'] += 1
+            scoring, found = job(n, numbers, THRESHOLD)
+            return finish(n, _score_one(targets, *scoring), found)
+        return full_matches
+
+    # work out which pairs still have to be scored
+    jobs = []
+    known = []      # cached matches of each job
+    exact_numbers = {}  # job -> candidates to score in full, for jobs on the fast path
+    for n in range(len(sorted_queries)):
+        query = sorted_queries[n]
+        if index is not None:
+            numbers = index.candidates(query, 0 if ranges is None else min(ranges[n])[0])
+        elif ranges is not None:
+            numbers = targets.window(len(query), THRESHOLD)
+        else:
+            numbers = None
+        same = identical.get(query, [])
+        for start, end in ([(0, len(targets))] if ranges is None else ranges[n]):
+            numbers_in, cutoff, exact_path = _plan(numbers, same, start, end)
+            if exact_path:
+                exact_numbers[len(jobs)] = _plan(numbers, [], start, end)[0]
+                counts['exact'] += 1
+            scoring, found = job(n, numbers_in, cutoff)
+            jobs.append(scoring)
+            known.append(found)
+
+    # the jobs of each query come one after another, one for each of its ranges
+    results = _run(jobs, targets, workers)
+    k = 0
+    for n in range(len(queries)):
+        query_matches = []
+        for r in range(1 if ranges is None else len(ranges[n])):
+            matches = finish(n, next(results), known[k])
+            if k in exact_numbers:
+                matches = ExactMatches(matches, fallback(n, exact_numbers[k]))
+            query_matches.append(matches)
+            k += 1
+        yield query_matches[0] if ranges is None else query_matches
+
+
+def match_store(store, ranges, index=None, workers=1, memory=MEMORY, sketch_threshold=SKETCH_THRESHOLD):
+    """Like 'match_all(songs[:len(ranges)], songs, index, workers, ranges=ranges)', for songs
+    whose token-sorted lyrics are in the 'store.TokenStore' 'store' rather than in memory:
+    the songs are scored a block at a time, and only about 'memory' bytes of lyrics are put
+    back together at once (in each process), with the postings of 'index' (a 'StoreIndex'
+    over 'store' with the first song of each query's ranges among its 'firsts', or None) for
+    the same block.  The result is the same as 'match_all' gives.
+    The candidates of each song are worked out once and kept in the store as well.
+    """
+    same = {}           # query number -> numbers of the songs identical to it, if there are any
+    for group in store.duplicates():
+        for n in group:
+            if n < len(ranges):
+                same[n] = group
+    blocks = store.blocks(memory)
+
+    if index is not None:
+        store.write_numbers('probes', (index.probes(n, min(ranges[n])[0]) for n in range(len(ranges))))
+        probes = store.read_numbers('probes')
+        block_candidates = []   # the candidates of each query in each block
+    else:
+        store.write_numbers('candidates', (window(store.by_length, store.sorted_lengths, store.lengths[n],
+                                                  THRESHOLD) for n in range(len(ranges))))
+        windows = store.read_numbers('candidates')
+
+    def candidates(n, b):
+        if index is not None:
+            return block_candidates[b][n]
+        first, last = blocks[b]
+        numbers = windows[n]
+        return numbers[bisect.bisect_left(numbers, first):bisect.bisect_left(numbers, last)]
+
+    def fallback(n, start, end):
+        def full_matches():
+            counts['fallback'] += 1
+            query = store[n]
+            numbers = [j for b in range(len(blocks)) if blocks[b][1] > start and blocks[b][0] < end
+                       for j in candidates(n, b)]
+            numbers = _plan(numbers, [], start, end)[0]
+            targets = SortedLyrics([store[j] for j in numbers], sketch_threshold,
+                                   [store.signature(j) for j in numbers], [store.histogram(j) for j in numbers])
+            return [(numbers[j], ratio) for j, ratio in score_row(query, targets, None, THRESHOLD,
+                                                                  None, store.signature(n))]
+        return full_matches
+
+    def score(jobs, owners, targets, first):
+        for (n, r), (matches, scored) in zip(owners, _run(jobs, targets, workers)):
+            all_matches[n][r].extend([(j + first, ratio) for j, ratio in matches])
+
+    all_matches = []
+    for n in range(len(ranges)):
+        all_matches.append([])
+        for start, end in ranges[n]:
+            if _plan([], same.get(n, [n]), start, end)[2]:
+                counts['exact'] += 1
+                all_matches[n].append(ExactMatches([], fallback(n, start, end)))
+            else:
+                all_matches[n].append([])
+
+    for b, (first, last) in enumerate(blocks):
+        if index is not None:
+            index.load(first, last)
+            name = 'candidates.{}'.format(b)
+            store.write_numbers(name, (index.candidates(n, probes[n], min(ranges[n])[0])
+                                       for n in range(len(ranges))))
+            block_candidates.append(store.read_numbers(name))
+        targets = SortedLyrics([store[j] for j in range(first, last)], sketch_threshold,
+                               [store.signature(j) for j in range(first, last)],
+                               [store.histogram(j) for j in range(first, last)])
+        jobs = []
+        owners = []     # (query, range) of each job
+        size = 0        # the number of songs to score in 'jobs'
+        for n in range(len(ranges)):
+            numbers = candidates(n, b)
+            if not numbers:
+                continue
+            query = store[n]
+            for r in range(len(ranges[n])):
+                start, end = ranges[n][r]
+                numbers_in, cutoff, exact_path = _plan(numbers, same.get(n, [n]), start, end)
+                if numbers_in:
+                    # positions in the block, rather than song numbers
+                    jobs.append((query, store.signature(n), [j - first for j in numbers_in], False, cutoff))
+                    owners.append((n, r))
+                    size += len(numbers_in)
+            # the jobs of a block are scored a batch at a time, so they don't take more than
+            #   about 'memory' bytes either
+            if size * NUMBER_SIZE >= memory:
+                score(jobs, owners, targets, first)
+                jobs = []
+                owners = []
+                size = 0
+        score(jobs, owners, targets, first)
+        del targets, jobs
+    if index is not None:
+        index.load(0, 0)
+    return all_matches
+
+
+def claim(matches, used):
+    """Pick the best match out of 'matches' (as returned by 'find_matches') that is not
+    already in the set 'used', and add it to 'used'.
+    If two songs have the same ratio, the first one in the list wins.
+    Returns (song number, ratio), or (None, 0) if there was no match.
+    """
+    best, best_ratio = None, 0
+    for j, ratio in matches:
+        if j not in used and ratio > best_ratio:
+            best, best_ratio = j, ratio
+    if best is None and isinstance(matches, ExactMatches):
+        return claim(matches.fallback(), used)
+    if best is not None:
+        used.add(best)
+    return best, best_ratio
+
+
+def check_index(queries, songs, index, first=0):
+    """Compare the matches found through 'index' against scoring every pair (brute force).
+    Args 'queries' and 'songs' are lists of 'songs.Song'; 'index' is a 'TokenIndex' over 'songs'.
+    Only the songs from number 'first' on are searched.
+    Returns a dict with the number of pairs scored each way, the number of matches each way,
+    the recall of the index (1.0 means nothing was missed) and the list of missed pairs.
+    """
+    report = {'brute_force_pairs': len(queries) * (len(songs) - first), 'index_pairs': 0}
+    ranges = [[(first, len(songs))]] * len(queries)
+    # the cascade is left out of both, so only what the index misses is counted
+    all_found = match_all(queries, songs, index, exact=False, ranges=ranges, sketch_threshold=0)
+    all_expected = match_all(queries, songs, exact=False, ranges=ranges, sketch_threshold=0)
+    for n in range(len(queries)):
+        report['index_pairs'] += len(index.candidates(token_cache.sort_tokens(queries[n].lyrics), first))
+    report.update(_compare(all_found, all_expected, 'index', 'brute_force'))
+    return report
+
+
+def check_cascade(queries, songs, first=0, sketch_threshold=SKETCH_THRESHOLD):
+    """Compare the matches found with the cascade (see 'SortedLyrics') against fuzzy-scoring
+    every pair that could reach the cutoff (the exhaustive scorer).
+    Args 'queries' and 'songs' are lists of 'songs.Song'; only the songs from number 'first'
+    on are searched.
+    Returns a dict with the number of pairs fuzzy-scored each way, the number of matches each
+    way, the recall of the cascade (1.0 means nothing was lost) and the list of missed pairs.
+    """
+    ranges = [[(first, len(songs))]] * len(queries)
+    before = counts['compared']
+    all_found = match_all(queries, songs, exact=False, ranges=ranges, sketch_threshold=sketch_threshold)
+    report = {'cascade_compared': counts['compared'] - before}
+    before = counts['compared']
+    all_expected = match_all(queries, songs, exact=False, ranges=ranges, sketch_threshold=0)
+    report['exhaustive_compared'] = counts['compared'] - before
+    report.update(_compare(all_found, all_expected, 'cascade', 'exhaustive'))
+    return report
+
+
+def _compare(all_found, all_expected, found_name, expected_name):
+    """Count the matches in 'all_found' and 'all_expected' (as returned by 'match_all' with one
+    range), and list the expected matches (query, song number, ratio) that weren't found.
+    """
+    report = {found_name + '_matches': 0, expected_name + '_matches': 0, 'missed': []}
+    for n in range(len(all_found)):
+        found = all_found[n][0]
+        expected = all_expected[n][0]
+        report[found_name + '_matches'] += len(found)
+        report[expected_name + '_matches'] += len(expected)
+        for j, ratio in expected:
+            if (j, ratio) not in found:
+                report['missed'].append((n, j, ratio))
+    if report[expected_name + '_matches'] == 0:
+        report['recall'] = 1.0
+    else:
+        report['recall'] = report[found_name + '_matches'] / report[expected_name + '_matches']
+    return report
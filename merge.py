@@ -0,0 +1,172 @@
+import matching
+import store
+from metrics import Metrics, Progress
+from songs import UNKNOWN_AUTHORS, UNKNOWN_TITLE
+
+# Matching songs against each other and deciding which ones to export (see script.py)
+#
+# The databases ('sources') are given as a list of song lists, in order of preference; script.py
+#   uses [SI_songs, HH_songs, LWS_songs].  All their songs are numbered one after another, and
+#   one candidate index is built over all of them.
+#
+# * Score every song against the songs of every later source, all in one batch
+#       (see 'matching.iter_matches').
+# * Go through the songs in order.  A song that hasn't been matched yet picks its best match
+#       out of each later source, among the songs that haven't been matched yet
+#       (see 'matching.claim'); the song and its matches are a 'cluster', which is exported
+#       right away (see 'export_cluster').  Songs of the last source that are left over are
+#       clusters of their own.
+#
+# The two steps run as a pipeline: the matches of each song are handed over as soon as they
+#   are worked out, while the worker processes go on scoring the songs after it, and the
+#   exporter writes the files of each cluster in the background (see 'exporter.Exporter').
+#   So the files are written while the songs are still being scored, rather than after.
+#
+# So for three sources this is what it always was: SI songs against HH and LWS songs, then the
+#   remaining HH songs against the remaining LWS songs, then the remaining LWS songs; and a
+#   fourth database is just one more list.  The scoring is the expensive part, and that is
+#   done once per song, against one index, however many sources there are.
+#
+# The time this takes is counted as the 'match' stage of a 'metrics.Metrics' (less the time
+#   spent in 'export', if that is timed as a stage of its own, and in the 'check' stage, if
+#   the index or the cascade is checked), along with the number of pairs fuzzy-scored and of
+#   matches found; each loop reports its progress now and then.
+
+
+def merge_songs(sources, export, workers=1, use_index=True, score_cache=None,
+                check_index=False, metrics=None, store_directory=None, memory=matching.MEMORY,
+                check_cascade=False):
+    """Match the song lists in 'sources' against each other, and call 'export' on every song
+    (version) that should go into the new database.
+    Arg 'workers' is the number of processes to score songs with, 'use_index' says whether to
+    use a candidate index (see 'matching.TokenIndex'), 'score_cache' is an optional
+    'cache.ScoreCache', and 'check_index' prints how the index compares with scoring every pair.
+    The titles and authors of matched songs are filled in from each other (the songs change).
+    Measurements are added to 'metrics' (a 'metrics.Metrics'), if given.
+    If a 'store_directory' is given, the token-sorted lyrics are kept in a 'store.TokenStore'
+    there instead of in memory, and matched about 'memory' bytes at a time (see
+    'matching.match_store'; the index is a 'matching.StoreIndex' then, and 'score_cache' isn't
+    used).
+    Arg 'check_cascade' prints how many matches the cascade loses (see 'matching.check_cascade').
+    """
+    if metrics is None:
+        metrics = Metrics()
+    with metrics.stage('match', sum(len(source) for source in sources)):
+        _merge_songs(sources, export, workers, use_index, score_cache, check_index, metrics,
+                     store_directory, memory, check_cascade)
+
+
+def _merge_songs(sources, export, workers, use_index, score_cache, check_index, metrics,
+                 store_directory, memory, check_cascade):
+    songs = [song for source in sources for song in source]
+    starts = [0]        # the number of the first song of each source, and then the total
+    for source in sources:
+        starts.append(starts[-1] + len(source))
+
+    misses = matching.token_cache.misses
+    token_store = None
+    if store_directory is not None:
+        token_store = store.TokenStore.create(store_directory, songs)
+    index = None
+    if use_index and token_store is not None:
+        # the queries of each source are matched against the songs from the next source on
+        index = matching.StoreIndex(token_store, starts[1:-1])
+    elif use_index:
+        index = matching.TokenIndex([matching.token_cache.sort_tokens(song.lyrics) for song in songs])
+    if (check_index and index is not None or check_cascade) and len(sources) > 1:
+        # the checks score every pair themselves: that is timed as a stage of its own, and
+        #   left out of the counts below
+        with metrics.stage('check'):
+            _check(sources, songs, starts, index if check_index else None, check_cascade)
+    before = dict(matching.counts)
+
+    # Looking for fuzzy similarities -- a BIG task.
+    #   Score every song against each later source; the songs of the last source have nothing
+    #   left to be scored against.
+    queries = songs[:starts[-2]] if sources else []
+    ranges = []
+    for k in range(len(sources) - 1):
+        later = [(starts[m], starts[m+1]) for m in range(k + 1, len(sources))]
+        ranges.extend([later] * len(sources[k]))
+    if token_store is not None:
+        all_matches = matching.match_store(token_store, ranges, index, workers, memory)
+    else:
+        all_matches = matching.iter_matches(queries, songs, index, workers, score_cache, ranges=ranges)
+    all_matches = iter(all_matches)
+
+    # Go through the songs in order, each picking its best match out of each later source
+    #   (if two songs of a source match, the one with the highest ratio is used)
+    used = set()        # store the numbers of already matched songs in here
+    progress = Progress('songs', len(songs))
+    for n in range(len(songs)):
+        progress.update(n + 1)
+        song_matches = next(all_matches) if n < len(queries) else []
+        if n in used:   # don't process songs that were already dealt with
+            continue
+        cluster = [(songs[n], 100)]
+        for matches in song_matches:
+            j, ratio = matching.claim(matches, used)
+            if j is not None:
+                cluster.append((songs[j], ratio))
+                metrics.count('matches')
+                if ratio == 100:
+                    metrics.count('exact_matches')
+        export_cluster(cluster, export)
+    if token_store is not None:
+        token_store.close()
+
+    metrics.count('pairs', matching.counts['pairs'] - before['pairs'])
+    metrics.count('comparisons', matching.counts['compared'] - before['compared'])
+    metrics.count('cascade_pruned', matching.counts['sketched'] - before['sketched'])
+    metrics.count('exact_fast_path', matching.counts['exact'] - before['exact'])
+    metrics.count('exact_fallbacks', matching.counts['fallback'] - before['fallback'])
+    # songs whose token-sorted lyrics weren't worked out while loading (or were dropped since)
+    metrics.count('token_cache_misses', matching.token_cache.misses - misses)
+
+
+def _check(sources, songs, starts, index, check_cascade):
+    """Print how the candidate 'index' (if not None) and the cascade (if 'check_cascade')
+    do against scoring every pair, for the first source against the rest."""
+    if isinstance(index, matching.StoreIndex):
+        # the check scores every pair in memory anyway
+        index = matching.TokenIndex([matching.token_cache.sort_tokens(song.lyrics) for song in songs])
+    if index is not None:
+        report = matching.check_index(sources[0], songs, index, starts[1])
+        print('first source vs the rest: scored {} of {} pairs, found {} of {} matches (recall {:.4f})'
+              .format(report['index_pairs'], report['brute_force_pairs'],
+                      report['index_matches'], report['brute_force_matches'], report['recall']))
+    if check_cascade:
+        report = matching.check_cascade(sources[0], songs, starts[1])
+        print('first source vs the rest: cascade fuzzy-scored {} of {} pairs, found {} of {} matches (recall {:.4f})'
+              .format(report['cascade_compared'], report['exhaustive_compared'],
+                      report['cascade_matches'], report['exhaustive_matches'], report['recall']))
+
+
+def export_cluster(cluster, export):
+    """Export one cluster of matched songs: a list of (song, ratio) with the first song of the
+    cluster first, and each other song's ratio with it.
+    * A song identical to the first song (ratio 100) is not exported: only one version of
+        identical songs goes into the database.
+    * Every version that is exported gets the same title (so that they show up side-by-side):
+        the first title known in the cluster; if there is none (e.g. an HH song that matched
+        nothing), the first line of the lyrics.
+    * Exported versions without authors get the first authors known in the cluster.
+    """
+    title = None
+    authors = UNKNOWN_AUTHORS
+    for song, ratio in cluster:
+        if title is None and song.title != UNKNOWN_TITLE:
+            title = song.title
+        if authors is UNKNOWN_AUTHORS and song.authors is not UNKNOWN_AUTHORS:
+            authors = song.authors
+    if title is None:
+        title = cluster[0][0].lyrics.split('\n', 1)[0]
+
+    for n in range(len(cluster)):
+        song, ratio = cluster[n]
+        if n > 0 and ratio == 100:
+            continue
+        song.title = title
+        if song.authors is UNKNOWN_AUTHORS:
+            song.authors = authors
+        export(song)
@@ -0,0 +1,124 @@
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+
+# Measuring where the time goes (see script.py)
+#
+# A 'Metrics' object keeps:
+#   * the time spent in each stage ('load_hh', 'match', 'export', ...) - a stage that runs
+#       inside another one (like 'export' inside 'match') is not counted twice: its time is
+#       taken out of the outer stage.  Stages may run in several threads at once (like the
+#       loaders); each thread keeps track of its own stages, and the times of stages that ran
+#       at the same time overlap (so 'total_seconds' can be more than the time the run took)
+#   * the number of songs each stage processed, for songs per second
+#   * any other counters ('comparisons', 'matches', ...)
+# and can write all of that out as JSON at the end of a run.
+#
+# A 'Progress' prints how far a long loop has got, at most once every INTERVAL seconds.
+
+INTERVAL = 2.0
+
+
+class Metrics:
+
+    def __init__(self):
+        self.seconds = {}
+        self.songs = {}
+        self.counters = {}
+        self._threads = threading.local()
+        self._lock = threading.Lock()
+
+    def _inner(self):
+        """For each stage this thread is in: the time spent in stages inside it."""
+        if not hasattr(self._threads, 'inner'):
+            self._threads.inner = []
+        return self._threads.inner
+
+    @contextlib.contextmanager
+    def stage(self, name, songs=0):
+        """Time the code in a 'with' block as (part of) stage 'name', which processes 'songs' songs."""
+        inner = self._inner()
+        start = time.perf_counter()
+        inner.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0.0) + elapsed - inner.pop()
+            if inner:
+                inner[-1] += elapsed
+            self.processed(name, songs)
+
+    def timed(self, name, function):
+        """Return 'function' wrapped so that each call counts as processing 1 song in stage 'name'."""
+        def wrapper(*args, **kwargs):
+            with self.stage(name, 1):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def processed(self, name, songs):
+        """Add 'songs' to the number of songs stage 'name' has processed."""
+        with self._lock:
+            self.songs[name] = self.songs.get(name, 0) + songs
+
+    def count(self, name, number=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + number
+
+    def summary(self):
+        """Return all measurements as a dict (see the top of this file)."""
+        stages = {}
+        for name in self.seconds:
+            stages[name] = {'seconds': round(self.seconds[name], 6), 'songs': self.songs[name]}
+            if self.songs[name] and self.seconds[name] > 0:
+                stages[name]['songs_per_second'] = round(self.songs[name] / self.seconds[name], 1)
+        return {'stages': stages, 'total_seconds': round(sum(self.seconds.values()), 6),
+                'counters': dict(self.counters)}
+
+    def write(self, path):
+        with open(path, 'w') as F:
+            json.dump(self.summary(), F, indent=2)
+
+
+class Progress:
+    """Reports progress through 'total' songs of a stage named 'label' to 'stream'."""
+
+    def __init__(self, label, total, interval=INTERVAL, stream=sys.stderr):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.start = self.last = time.perf_counter()
+
+    def update(self, done):
+        """Call with the number of songs done so far; prints only if it's been a while."""
+        now = time.perf_counter()
+        if now - self.last >= self.interval or done == self.total:
+            self.last = now
+            rate = done / (now - self.start) if now > self.start else 0.0
+            percent = 100 * done / self.total if self.total else 100
+            self.stream.write('{}: {}/{} ({:.0f}%), {:.0f} songs/s\n'
+                              .format(self.label, done, self.total, percent, rate))
+            self.stream.flush()
+
+
+@contextlib.contextmanager
+def profiled(path):
+    """Run the code in a 'with' block under cProfile and write the stats to 'path'
+    (for 'python -m pstats <path>'); does nothing if 'path' is None.
+    Only this process is profiled, not the worker processes.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
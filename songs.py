@@ -0,0 +1,70 @@
+import sys
+
+# Song records
+#
+# Every song loaded from one of the databases is a 'Song', which holds:
+#   * lyrics (string)
+#       - a verse is made of lyric lines without any blank lines in between,
+#           and verses are separated by one blank line i.e. ('\n\n')
+#   * title (string)
+#       - 'Unknown' if no title is available
+#   * authors (tuple of strings)
+#       - ('Author Unknown',) if no authors are available
+#   * source (string) - the database the song came from: 'HH', 'LWS' or 'SI'
+#   * number (int) - the position of the song in its database's list
+#
+# Author names are interned, so the many songs by the same author all share one string, and
+#   every song without authors shares the tuple UNKNOWN_AUTHORS.  (Titles are not interned:
+#   nearly every title is different, so interning them would only cost memory, and the
+#   titles that do repeat - 'Unknown', and titles copied from a matched song - are already
+#   shared.)  Authors are a tuple rather than a list so that sharing them is
+#   safe; to change the first author, assign to 'song.author'.
+#
+# Memory use per 10,000 songs, not counting the lyrics strings themselves (measured with
+#   'tracemalloc', 64-bit CPython 3.11, titles and author names made up like the real ones):
+#                           [lyrics, title, authors] lists     'Song' records
+#       HH songs                      2.5 MB                       2.3 MB
+#       LWS songs                     2.1 MB                       1.7 MB
+#       SI songs                      2.5 MB                       2.1 MB
+#   Most of what is left is the title and author strings and the 'number' ints.
+
+UNKNOWN_TITLE = 'Unknown'
+UNKNOWN_AUTHOR = 'Author Unknown'
+UNKNOWN_AUTHORS = (UNKNOWN_AUTHOR,)
+
+
+class Song:
+    __slots__ = ('lyrics', 'title', 'authors', 'source', 'number')
+
+    def __init__(self, lyrics, title, authors, source, number):
+        self.lyrics = lyrics
+        self.title = title
+        self.authors = intern_authors(authors)
+        self.source = source
+        self.number = number
+
+    def __repr__(self):
+        return 'Song({}[{}]: {!r})'.format(self.source, self.number, self.title)
+
+    @property
+    def author(self):
+        """The first author of the song."""
+        return self.authors[0]
+
+    @author.setter
+    def author(self, author):
+        self.authors = intern_authors((author,) + self.authors[1:])
+
+    # songs are pickled when they are sent to other processes
+    def __getstate__(self):
+        return (self.lyrics, self.title, self.authors, self.source, self.number)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+def intern_authors(authors):
+    """Return the list of author names 'authors' as a tuple of interned strings."""
+    if len(authors) == 1 and authors[0] == UNKNOWN_AUTHOR:
+        return UNKNOWN_AUTHORS
+    return tuple(author if author is None else sys.intern(author) for author in authors)
@@ -0,0 +1,226 @@
+import array
+import hashlib
+import mmap
+import os
+import matching
+
+# Token-sorted lyrics on disk, for matching more songs than fit in memory (see 'matching.match_store')
+#
+# A 'TokenStore' is a directory with:
+#   * 'vocabulary.txt' - every token (normalized word, see 'matching.sort_tokens'), one per line;
+#       a token's id is its line number
+#   * 'tokens.bin'     - the token-sorted lyrics of every song, one after another, as token ids
+#       (unsigned 32-bit integers)
+#   * 'offsets.bin'    - where the tokens of each song start in 'tokens.bin' (unsigned 64-bit),
+#       and then the total number of tokens
+#   * 'lengths.bin'    - the length of each song's token-sorted lyrics string (unsigned 32-bit)
+#   * 'signatures.bin' - the signature of each song for the cascade (see 'matching.signature'),
+#       SIGNATURE_SIZE bytes each
+#   * 'histograms.bin' - the character histogram of each song's token-sorted lyrics (see
+#       'matching.histogram'), as HISTOGRAM_SIZE unsigned 32-bit integers
+# The '.bin' files are memory-mapped, so only the parts being used are read into memory; the
+#   token-sorted lyrics of a song are put back together from its ids when they are needed.
+#   Lists of song numbers worked out while matching (e.g. the candidates of each song) can be
+#   kept in the store as well ('write_numbers', 'read_numbers').
+# What is kept in memory for every song is just a few numbers (e.g. its place in the order of
+#   length), besides the vocabulary.  This only bounds the memory that matching takes: the
+#   songs themselves ('songs.Song', with their full lyrics) are all still loaded and kept in
+#   memory by script.py, which exports them.
+
+BLOCK = 1 << 16     # songs are written this many at a time
+SIGNATURE_SIZE = matching.SKETCH_BITS // 4
+HISTOGRAM_SIZE = len(matching.ALPHABET) + 1
+
+
+def _write_array(F, typecode, values):
+    array.array(typecode, values).tofile(F)
+
+
+class TokenStore:
+    """The token store in 'directory' (see 'TokenStore.create' to make one)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'vocabulary.txt')) as F:
+            self.vocabulary = F.read().split('\n')[:-1]
+        self.maps = []
+        self.views = []
+        self.files = []
+        self.tokens = self._map('tokens.bin', 'I')
+        self.offsets = self._map('offsets.bin', 'Q')
+        self.lengths = self._map('lengths.bin', 'I')
+        self.signatures = self._map('signatures.bin', 'B')
+        self.histograms = self._map('histograms.bin', 'I')
+        # song numbers in order of length, for 'matching.window'
+        self.by_length = array.array('I', sorted(range(len(self)), key=self.lengths.__getitem__))
+        self.sorted_lengths = array.array('I', [self.lengths[j] for j in self.by_length])
+
+    def _map(self, name, typecode):
+        with open(os.path.join(self.directory, name), 'rb') as F:
+            if os.fstat(F.fileno()).st_size == 0:
+                return array.array(typecode)
+            mapped = mmap.mmap(F.fileno(), 0, access=mmap.ACCESS_READ)
+        self.maps.append(mapped)
+        view = memoryview(mapped).cast(typecode)
+        self.views.append(view)
+        return view
+
+    # stores are sent to worker processes by name, and each process maps the files itself
+    def __getstate__(self):
+        return self.directory
+
+    def __setstate__(self, directory):
+        self.__init__(directory)
+
+    @classmethod
+    def create(cls, directory, songs):
+        """Write the token-sorted lyrics of every song in the list 'songs' (of 'songs.Song')
+        to a new store in 'directory', and return it.
+        """
+        os.makedirs(directory, exist_ok=True)
+        ids = {}
+        with open(os.path.join(directory, 'tokens.bin'), 'wb') as tokens, \
+             open(os.path.join(directory, 'offsets.bin'), 'wb') as offsets, \
+             open(os.path.join(directory, 'lengths.bin'), 'wb') as lengths, \
+             open(os.path.join(directory, 'signatures.bin'), 'wb') as signatures, \
+             open(os.path.join(directory, 'histograms.bin'), 'wb') as histograms:
+            total = 0
+            for start in range(0, len(songs), BLOCK):
+                block_tokens = array.array('I')
+                block_offsets = []
+                block_lengths = []
+                block_histograms = array.array('I')
+                for song in songs[start:start+BLOCK]:
+                    text = matching.token_cache.sort_tokens(song.lyrics)
+                    words = text.split()
+                    block_offsets.append(total)
+                    block_lengths.append(len(text))
+                    block_tokens.extend([ids.setdefault(word, len(ids)) for word in words])
+                    block_histograms.extend(matching.histogram(text))
+                    total += len(words)
+                    signatures.write(matching.signature_bytes(matching.token_cache.signature(song.lyrics)))
+                block_tokens.tofile(tokens)
+                _write_array(offsets, 'Q', block_offsets)
+                _write_array(lengths, 'I', block_lengths)
+                block_histograms.tofile(histograms)
+            _write_array(offsets, 'Q', [total])
+        with open(os.path.join(directory, 'vocabulary.txt'), 'w') as F:
+            for word in ids:
+                F.write(word + '\n')
+        return cls(directory)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, j):
+        """Return the token-sorted lyrics of song 'j'."""
+        vocabulary = self.vocabulary
+        return ' '.join([vocabulary[i] for i in self.token_ids(j)])
+
+    def token_ids(self, j):
+        """Return the token ids of song 'j', in order."""
+        return self.tokens[self.offsets[j]:self.offsets[j+1]]
+
+    def signature(self, j):
+        """Return the signature of song 'j' (see 'matching.signature')."""
+        return matching.from_signature_bytes(self.signatures[SIGNATURE_SIZE*j:SIGNATURE_SIZE*(j+1)])
+
+    def histogram(self, j):
+        """Return the character histogram of song 'j' (see 'matching.histogram')."""
+        return self.histograms[HISTOGRAM_SIZE*j:HISTOGRAM_SIZE*(j+1)]
+
+    def fingerprint(self, j):
+        """Return a hash of song 'j's tokens; songs with the same token-sorted lyrics (and only
+        those, barring a 1 in 2**128 accident) have the same fingerprint.
+        """
+        return hashlib.blake2b(self.token_ids(j), digest_size=16).digest()
+
+    def duplicates(self):
+        """Return a list of the groups of songs with the same token-sorted lyrics (as sorted
+        lists of song numbers), leaving out songs that have no duplicate.  Such songs have
+        the same length as well, so they are looked for among the songs of each length in
+        turn, rather than all at once.
+        """
+        groups = []
+        start = 0
+        for end in range(1, len(self) + 1):
+            if end < len(self) and self.sorted_lengths[end] == self.sorted_lengths[start]:
+                continue
+            if end - start > 1:
+                identical = {}
+                for j in self.by_length[start:end]:
+                    identical.setdefault(self.fingerprint(j), []).append(j)
+                groups.extend(group for group in identical.values() if len(group) > 1)
+            start = end
+        return groups
+
+    def blocks(self, memory):
+        """Split the songs into ranges (start, end) of song numbers whose token-sorted lyrics
+        take about 'memory' bytes at most when they are put back together.
+        """
+        blocks = []
+        start = size = 0
+        for j in range(len(self)):
+            song_size = self.lengths[j] + matching.SONG_OVERHEAD
+            if j > start and size + song_size > memory:
+                blocks.append((start, j))
+                start, size = j, 0
+            size += song_size
+        if start < len(self):
+            blocks.append((start, len(self)))
+        return blocks
+
+    def write_numbers(self, name, lists):
+        """Write the lists of song numbers in the iterable 'lists' to the files '<name>.bin'
+        and '<name>.offsets.bin' in the store.
+        """
+        with open(os.path.join(self.directory, name + '.bin'), 'wb') as numbers, \
+             open(os.path.join(self.directory, name + '.offsets.bin'), 'wb') as offsets:
+            total = 0
+            block_numbers = array.array('I')
+            block_offsets = []
+            for numbers_list in lists:
+                block_offsets.append(total)
+                block_numbers.extend(numbers_list)
+                total += len(numbers_list)
+                if len(block_offsets) == BLOCK or len(block_numbers) >= BLOCK:
+                    block_numbers.tofile(numbers)
+                    _write_array(offsets, 'Q', block_offsets)
+                    block_numbers = array.array('I')
+                    block_offsets = []
+            block_numbers.tofile(numbers)
+            _write_array(offsets, 'Q', block_offsets + [total])
+
+    def read_numbers(self, name):
+        """Return the lists written by 'write_numbers(name, ...)', as a list-like object whose
+        items are read from the files when they are asked for.
+        """
+        numbers = open(os.path.join(self.directory, name + '.bin'), 'rb')
+        self.files.append(numbers)
+        return _NumberLists(numbers, self._map(name + '.offsets.bin', 'Q'))
+
+    def close(self):
+        for view in self.views:
+            view.release()
+        for mapped in self.maps:
+            mapped.close()
+        for F in self.files:
+            F.close()
+
+
+# The lists are read with plain reads rather than mapped: each one is read once per block, and
+#   mapping the file would keep all of it in the process's memory after the first block.
+class _NumberLists:
+
+    def __init__(self, F, offsets):
+        self.F = F
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        start = self.offsets[n]
+        numbers = array.array('I')
+        numbers.frombytes(os.pread(self.F.fileno(), 4 * (self.offsets[n+1] - start), 4 * start))
+        return numbers.tolist()
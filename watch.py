@@ -0,0 +1,172 @@
+import os
+import pickle
+import signal
+import time
+import loaders
+import matching
+import merge
+
+# Watch mode (see script.py): keeping the new database up to date as new SI songs come in
+#
+# Editors export new songs from OpenLP into the SI directory one or two at a time.  Instead of
+#   running the whole script again for each one, a 'Watcher' keeps the songs already in the
+#   database in memory - their token signatures, titles and authors from the manifest (see
+#   'manifest.py'), with a candidate index and a length-sorted list over the signatures (see
+#   'matching.TokenIndex' and 'matching.SortedLyrics') - and looks at the SI directory every
+#   POLL_INTERVAL seconds.  Every XML file that is new, or has changed since it was last
+#   looked at, is read and dealt with the way append mode deals with a new song:
+#   * if a song with the same lyrics was seen before, nothing happens;
+#   * otherwise the song is matched against the songs in the database; if its best match is
+#       identical, it isn't written, otherwise it is written - under the title of its best
+#       match, if it has one (see 'merge.export_cluster');
+#   * a song that is written is added to the index and the list right away (they are never
+#       built again from scratch), so the next song is matched against it as well.
+#   Only the one song is read and scored, so it is in the database well within a second.
+#   Files that go away are forgotten; the database is never changed, only added to.
+#
+# The state of the watcher (the songs, the index and the list) can be saved to a snapshot file
+#   after every change, and read back the next time instead of being built again; songs that
+#   were added to the manifest since the snapshot (in append mode) are added to it then.
+
+POLL_INTERVAL = 0.5
+SNAPSHOT_VERSION = 3    # snapshots of other versions are built again from scratch
+
+
+def scan(directory):
+    """Return {file name: (modification time, size)} for every XML file in 'directory'."""
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.xml') and not entry.name.startswith('.') and entry.is_file():
+                stat = entry.stat()
+                files[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+class Watcher:
+    """Keeps the database recorded in 'song_manifest' (a 'manifest.Manifest') up to date with
+    the SI songs in 'directory'.
+    Arg 'files' is what 'scan(directory)' gave before the SI songs were loaded; those files
+    are only looked at again once they change.  Arg 'snapshot' is the file to keep the state
+    in (None: don't).
+    """
+
+    def __init__(self, directory, song_manifest, files=None, snapshot=None):
+        self.directory = directory
+        self.manifest = song_manifest
+        self.files = {} if files is None else dict(files)
+        self.snapshot = snapshot
+        self.number = len(self.files)   # for numbering the songs that are read
+        if snapshot is None or not self._restore():
+            self.entries = []   # (file name, fingerprint) of each song in the database
+            self.songs = []     # the songs, with their token signatures as lyrics
+            self.targets = matching.SortedLyrics([])
+            self.index = matching.TokenIndex([])
+        self._update()
+
+    def _restore(self):
+        """Read the state back from the snapshot; returns whether it is still good."""
+        try:
+            with open(self.snapshot, 'rb') as F:
+                state = pickle.load(F)
+        except FileNotFoundError:
+            return False
+        except (OSError, EOFError, KeyError, pickle.UnpicklingError) as error:
+            print('Warning: ignoring unreadable watch snapshot {}: {}'.format(self.snapshot, error))
+            return False
+        # the database must still start with the same songs, with the same lyrics (it is
+        #   rewritten unless appending, and changed songs are written over their files)
+        if state.get('version') != SNAPSHOT_VERSION or \
+                self.manifest.files()[:len(state['entries'])] != state['entries']:
+            return False
+        self.entries = state['entries']
+        self.songs = state['songs']
+        self.targets = state['targets']
+        self.index = state['index']
+        return True
+
+    def save(self):
+        """Write the state to the snapshot file (if there is one)."""
+        if self.snapshot is None:
+            return
+        state = {'version': SNAPSHOT_VERSION, 'entries': self.entries, 'songs': self.songs,
+                 'targets': self.targets, 'index': self.index}
+        temp = self.snapshot + '.tmp'
+        with open(temp, 'wb') as F:
+            pickle.dump(state, F, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp, self.snapshot)
+
+    def _update(self):
+        """Add the songs that were added to the manifest since the last time."""
+        start = len(self.entries)
+        self.entries.extend(self.manifest.files(start))
+        for song in self.manifest.songs(start):
+            self.songs.append(song)
+            self.targets.append(song.lyrics, matching.token_cache.signature(song.lyrics))
+            self.index.add(song.lyrics)
+
+    def add_song(self, song, export):
+        """Deal with one SI song (see the top of this file), calling 'export' on it if it
+        should be written.  Returns what was done, for printing.
+        """
+        if not self.manifest.is_new(song):
+            return 'seen before'
+        self.manifest.track([song])
+        query = matching.token_cache.sort_tokens(song.lyrics)
+        matches = matching.score_row(query, self.targets, self.index.candidates(query),
+                                     query_signature=matching.token_cache.signature(song.lyrics))
+        j, ratio = matching.claim(matches, set())
+        self.manifest.add_seen([song])
+        if j is None:
+            merge.export_cluster([(song, 100)], export)
+            return 'written'
+        match = self.songs[j]
+        merge.export_cluster([(match, 100), (song, ratio)], export)
+        if ratio == 100:
+            return 'identical to {!r}'.format(match.title)
+        return 'written as a version of {!r} (ratio {})'.format(match.title, ratio)
+
+    def poll(self, song_database):
+        """Look at the SI directory once, and deal with every XML file that is new or has
+        changed, writing songs with 'song_database' (an 'exporter.Exporter').
+        Returns the number of files that were looked at.
+        """
+        files = scan(self.directory)
+        changed = sorted(name for name in files if self.files.get(name) != files[name])
+        export = self.manifest.exporter(song_database.export)
+        for name in changed:
+            song, error = loaders.read_si_song(os.path.join(self.directory, name), self.number)
+            if error is not None:
+                # maybe it is still being written; it is read again once it changes
+                print('Error: could not read SI song {}: {}'.format(name, error))
+                continue
+            self.number += 1
+            print('SI song {}: {}'.format(name, self.add_song(song, export)))
+            self._update()
+        self.files = files
+        if changed:
+            song_database.flush()
+            self.manifest.save()
+            self.save()
+        return len(changed)
+
+    def run(self, song_database, interval=POLL_INTERVAL):
+        """Poll the SI directory every 'interval' seconds until interrupted (Ctrl-C, or
+        SIGTERM), then close 'song_database'.
+        """
+        print('Watching {} for new songs (Ctrl-C to stop)'.format(self.directory))
+        signal.signal(signal.SIGTERM, _stop)
+        try:
+            while True:
+                start = time.perf_counter()
+                self.poll(song_database)
+                time.sleep(max(0.0, interval - (time.perf_counter() - start)))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            song_database.close()
+            self.manifest.save()
+
+
+def _stop(signum, frame):
+    raise KeyboardInterrupt